@@ -1,5 +1,8 @@
+import bisect
 import random
+import difflib
 import logging
+import functools
 from enum import Enum, IntEnum
 
 logger = logging.getLogger(__name__)
@@ -120,10 +123,92 @@ class NoUniqueWinnerError(Error):
         self.vote = vote
 
 
+class PlayerNotFoundError(Error):
+    """Raised when no living player goes by that name"""
+    def __init__(self, name=None, context=None):
+        self.context = context
+        self.name = name
+
+
+class AmbiguousPlayerError(Error):
+    """Raised when a name fits more than one living player"""
+    def __init__(self, name=None, players=None, context=None):
+        self.context = context
+        self.name = name
+        self.players = players or []
+
+
+def journaled(record_args=None):
+    """record the outermost calls of a Game method in the game's journal
+
+    Calls the game makes itself (like vote_user -> cycle) are left out,
+    replaying the outer call repeats them. record_args(game, args) can
+    replace what gets recorded, e.g. the outcome of random choices.
+    """
+    def decorator(method):
+        name = method.__name__
+
+        @functools.wraps(method)
+        def wrapper(self, *args):
+            outermost = self._journal_depth == 0
+            self._journal_depth += 1
+            try:
+                return method(self, *args)
+            finally:
+                self._journal_depth -= 1
+                # even failed calls, they might have changed something
+                if outermost and self.journal is not None:
+                    if record_args is not None:
+                        args = record_args(self, args)
+                    self.journal.record(self, name, args)
+        return wrapper
+    return decorator
+
+
+class GameObserver():
+    """gets told about changes to a Game, see Game.observers"""
+
+    def players_changed(self, game, players):
+        """players (None: could be anybody) or the game status changed"""
+
+    def round_over(self, game, role):
+        """the votes of role (None: everybody's) are about to be cleared"""
+
+    def game_ending(self, game):
+        """the game is about to be reset"""
+
+
+class VoteBatch():
+    """What the votes passed to Game.vote_users added up to"""
+    __slots__ = ('cast', 'results', 'errors')
+
+    def __init__(self):
+        self.cast = 0  # votes that got counted
+        # VoteReturnObjects of the votes that finished a vote
+        self.results = []
+        self.errors = []  # (position, error) of the votes that failed
+
+    @property
+    def consequences(self):
+        """everything the votes caused, in order"""
+        consequences = []
+        for result in self.results:
+            for vote in (result, result.parallel_vote):
+                if vote is not None and vote.consequence is not None:
+                    consequences.append(vote.consequence)
+        return consequences
+
+
 class Player():
-    def __init__(self, ID, name=None, role=Role.UNASSIGNED):
+    # big lobbies and lots of games, so no __dict__ per player
+    __slots__ = ('ID', 'name', 'aliases', '_role', '_status', 'last_vote',
+                 'death_cause')
+
+    def __init__(self, ID, name=None, role=Role.UNASSIGNED, aliases=()):
         self.ID = ID
         self.name = name
+        # other names people might know them by
+        self.aliases = tuple(aliases)
         self._role = role
         self._status = PlayerStatus.JOINED
         self.last_vote = None
@@ -135,6 +220,9 @@ class Player():
         # so we treat players with the same ID as equal
         return self.ID == other.ID
 
+    def __hash__(self):
+        return hash(self.ID)
+
     @property
     def status(self):
         return self._status
@@ -142,7 +230,7 @@ class Player():
     @status.setter
     def status(self, status):
         self._status = status
-        logger.debug(f'Player {self.name} status changed to {self.status}.')
+        logger.debug('Player %s status changed to %s.', self.name, status)
 
     @property
     def role(self):
@@ -151,7 +239,7 @@ class Player():
     @role.setter
     def role(self, role):
         self._role = role
-        logger.debug(f'Player {self.name} role changed to {self.role}.')
+        logger.debug('Player %s role changed to %s.', self.name, role)
 
     def is_dead(self):
         if self.status == PlayerStatus.DEAD:
@@ -162,24 +250,202 @@ class Player():
     def kill(self, cause):
         self.status = PlayerStatus.DEAD
         self.death_cause = cause
-        logger.debug(f'Killed a player by cause of {self.death_cause}')
+        logger.debug('Killed a player by cause of %s', cause)
 
 
-class Game:
-    MAFIA_RATIO = 0.6  # x mafias per players
-    COP_RATIO = 0.6  # x cops per players
+class VoteTally():
+    """Running vote counts for a group of voters.
+
+    Targets are bucketed by their number of votes, so the leader of the
+    vote (and whether there is a unique one) is known without scanning.
+    """
+    __slots__ = ('counts', 'buckets', 'top')
+
+    def __init__(self):
+        self.counts = {}  # target -> number of votes
+        self.buckets = {}  # number of votes -> set of targets
+        self.top = 0
+
+    def add(self, target, votes=1):
+        count = self.counts.get(target, 0)
+        if count:
+            self._unbucket(target, count)
+        self.counts[target] = count + votes
+        self.buckets.setdefault(count + votes, set()).add(target)
+        if count + votes > self.top:
+            self.top = count + votes
+
+    def remove(self, target):
+        count = self.counts[target]
+        self._unbucket(target, count)
+        if count > 1:
+            self.counts[target] = count - 1
+            self.buckets.setdefault(count - 1, set()).add(target)
+        else:
+            del self.counts[target]
+        if count == self.top and count not in self.buckets:
+            # the target was the last one on top and just moved down
+            self.top -= 1
+
+    def _unbucket(self, target, count):
+        bucket = self.buckets[count]
+        bucket.discard(target)
+        if not bucket:
+            del self.buckets[count]
+
+    def winner(self, player_total):
+        """the unique most voted target, False if there is none"""
+        if self.top == 0:
+            # nobody voted, so every player is tied at zero votes
+            return 0 if player_total == 1 else False
+        leaders = self.buckets[self.top]
+        if len(leaders) > 1:
+            # there were at least 2 highest votes
+            return False
+        return next(iter(leaders))
+
+
+class RoleDistribution():
+    """How many mafia and cops a lobby gets, and who gets to be one.
+
+    Lobbies smaller than the tables look their numbers up there, bigger
+    ones use the ratios. The config is checked up front, so handing out
+    roles is a single shuffle that can't fail.
+    """
+    MAFIA_RATIO = 0.3  # x mafias per players
+    COP_RATIO = 0.1  # x cops per players
     MAFIA_AMOUNTS = [0, 1, 1, 1, 2, 2, 2, 3, 3, 3]  # mafia for player counts
-    COP_AMOUNTS = [0, 1, 1, 1, 1, 1, 1, 1, 1, 1]  # cops for player counts
+    COP_AMOUNTS = [0, 0, 1, 1, 1, 1, 1, 1, 1, 1]  # cops for player counts
+
+    def __init__(self, mafia_ratio=None, cop_ratio=None,
+                 mafia_amounts=None, cop_amounts=None, seed=None):
+        self.mafia_ratio = (RoleDistribution.MAFIA_RATIO
+                            if mafia_ratio is None else mafia_ratio)
+        self.cop_ratio = (RoleDistribution.COP_RATIO
+                          if cop_ratio is None else cop_ratio)
+        self.mafia_amounts = list(RoleDistribution.MAFIA_AMOUNTS
+                                  if mafia_amounts is None else mafia_amounts)
+        self.cop_amounts = list(RoleDistribution.COP_AMOUNTS
+                                if cop_amounts is None else cop_amounts)
+        # own random generator if we want reproducible games
+        self.random = random if seed is None else random.Random(seed)
+        self.validate()
+
+    def validate(self):
+        if not (0 <= self.mafia_ratio and 0 <= self.cop_ratio and
+                self.mafia_ratio + self.cop_ratio <= 1):
+            raise ValueError('role ratios have to be positive and add up '
+                             'to 1 at most')
+        if len(self.mafia_amounts) != len(self.cop_amounts):
+            raise ValueError('mafia and cop tables need the same length')
+        for player_total, (mafia_total, cop_total) in enumerate(
+                zip(self.mafia_amounts, self.cop_amounts)):
+            if (mafia_total < 0 or cop_total < 0 or
+                    mafia_total + cop_total > player_total):
+                raise ValueError(f'{mafia_total} mafia and {cop_total} '
+                                 f'cops don\'t fit {player_total} players')
+
+    def counts(self, player_total):
+        """(mafia, cops) for a lobby of player_total"""
+        if player_total < len(self.mafia_amounts):
+            return (self.mafia_amounts[player_total],
+                    self.cop_amounts[player_total])
+        return (int(self.mafia_ratio * player_total),
+                int(self.cop_ratio * player_total))
+
+    def roles(self, player_total):
+        """a random role for each of player_total players"""
+        mafia_total, cop_total = self.counts(player_total)
+        roles = ([Role.MAFIA] * mafia_total + [Role.COP] * cop_total +
+                 [Role.VILLAGER] * (player_total - mafia_total - cop_total))
+        self.random.shuffle(roles)
+        return roles
+
+
+class NameIndex():
+    """Finds living players by what people type for them.
+
+    Ignores case and tries exact names first, then prefixes, then
+    the closest name if there's one that's close enough.
+    """
+    __slots__ = ('ids', 'names')
+    FUZZY_CUTOFF = 0.75
 
     def __init__(self):
+        self.ids = {}  # casefolded name -> IDs
+        self.names = []  # sorted casefolded names, for prefixes
+
+    @staticmethod
+    def fold(name):
+        return ' '.join(name.split()).casefold()
+
+    def add(self, player):
+        for name in (player.name, *player.aliases):
+            if not name:
+                continue
+            key = NameIndex.fold(name)
+            if key not in self.ids:
+                self.ids[key] = set()
+                bisect.insort(self.names, key)
+            self.ids[key].add(player.ID)
+
+    def remove(self, player):
+        for name in (player.name, *player.aliases):
+            if not name:
+                continue
+            key = NameIndex.fold(name)
+            ids = self.ids.get(key)
+            if ids is None:
+                continue
+            ids.discard(player.ID)
+            if not ids:
+                del self.ids[key]
+                del self.names[bisect.bisect_left(self.names, key)]
+
+    def find(self, name):
+        """IDs of the players that name fits best, maybe none"""
+        key = NameIndex.fold(name)
+        if not key:
+            return set()
+        if key in self.ids:
+            return set(self.ids[key])
+        found = set()
+        i = bisect.bisect_left(self.names, key)
+        while i < len(self.names) and self.names[i].startswith(key):
+            found |= self.ids[self.names[i]]
+            i += 1
+        if found:
+            return found
+        # votes can't be taken back, so two close names are ambiguous
+        for close in difflib.get_close_matches(key, self.names, 2,
+                                               NameIndex.FUZZY_CUTOFF):
+            found |= self.ids[close]
+        return found
+
+
+class Game:
+    def __init__(self, distribution=None):
+        self.distribution = (distribution if distribution is not None
+                             else RoleDistribution())
         self._status = GameStatus.NOT_RUNNING
         self.players = []
+        # goes up whenever who's playing, their roles, who's alive or the
+        # game status changes, so anything shown about those can be cached
+        self.version = 0
+        # GameObserver instances
+        self.observers = []
+        # discord ID -> position in self.players
+        self._player_index = {}
         self.mafia_vote_finished = False
         self.cop_vote_finished = False
         self.day_vote_finished = False
         self.cop_total = 0
         self.mafia_total = 0
         self.villager_total = 0
+        self._reset_tallies()
+        # see journaled()
+        self.journal = None
+        self._journal_depth = 0
         logger.debug('Created a game.')
 
     @property
@@ -189,22 +455,28 @@ class Game:
     @status.setter
     def status(self, status):
         self._status = status
-        logger.debug(f'Game status set to {self.status}.')
+        self._changed()
+        logger.debug('Game status set to %s.', status)
 
     # Actions
 
-    def join(self, ID, name):
-        player = Player(ID, name)
-        if player in self.players:
+    @journaled()
+    def join(self, ID, name, *aliases):
+        player = Player(ID, name, aliases=aliases)
+        if ID in self._player_index:
             raise AlreadyJoinedError(player)
         elif self.status != GameStatus.NOT_RUNNING:
             raise AlreadyRunningError
         else:
+            self._player_index[ID] = len(self.players)
             self.players.append(player)
+            self._changed((player,))
         logger.debug('Added a player.')
         return player
 
-    def start(self):
+    @journaled(lambda game, args: ([p.role.value for p in game.players],))
+    def start(self, roles=None):
+        """start the game, with the given roles (values) or random ones"""
         if self.status != GameStatus.NOT_RUNNING:
             raise AlreadyRunningError
         self.cop_vote_finished = False
@@ -213,24 +485,66 @@ class Game:
         self.cop_total = 0
         self.villager_total = 0
         self.mafia_total = 0
-        self.assign_roles()
+        if roles is None:
+            self.assign_roles()
+        else:
+            self.apply_roles(roles)
         for p in self.players:
             p.status = PlayerStatus.ALIVE
+        self._changed(self.players)
+        self._reset_tallies()
         self.cycle()
         logger.debug('Started the game.')
 
+    @journaled()
     def stop(self):
         if self.status == GameStatus.NOT_RUNNING:
             raise NotRunningError
         self.reset()
         logger.debug('Stopped the game.')
 
+    @journaled()
     def vote_user(self, p, target, target2=None):
-        p = self.players.index(Player(p))
-        if (Player(target) not in self.players):
+        p, target, votetype = self._cast_vote(p, target)
+        return self._vote_result(p, target, votetype)
+
+    def vote_users(self, votes):
+        """cast (voter, target) votes in order, e.g. for replays
+
+        Only votes that finish a vote get the whole vote_user treatment,
+        the rest just get counted. Errors don't stop the batch, they
+        end up in the returned VoteBatch like the consequences do.
+        """
+        return self._vote_users([list(vote) for vote in votes])
+
+    @journaled()
+    def _vote_users(self, votes):
+        batch = VoteBatch()
+        # the tallies only get looked at when a vote finishes,
+        # until then collect the votes and add them up in one go
+        uncounted = {}
+        for i, (p, target) in enumerate(votes):
+            try:
+                p, target, votetype = self._cast_vote(p, target, uncounted)
+                if self._vote_completes(votetype):
+                    self._count_votes(uncounted)
+                    batch.results.append(
+                        self._vote_result(p, target, votetype))
+            except (Error, ValueError) as err:
+                # ValueError: the voter isn't playing, see index_of
+                batch.errors.append((i, err))
+            else:
+                batch.cast += 1
+        self._count_votes(uncounted)
+        return batch
+
+    def _cast_vote(self, p, target, uncounted=None):
+        """check and count a vote, returns the voter's and target's index"""
+        p = self.index_of(p)
+        if not self.has_player(target):
             raise WrongVoteError
         else:
-            target = self.players.index(Player(target))
+            target = self._player_index[target]
         if self.players[p].last_vote is not None:
             raise AlreadyVotedError(self.players[p])
         if self.status not in [GameStatus.DAY_VOTE, GameStatus.NIGHT_VOTE]:
@@ -248,7 +562,8 @@ class Game:
             elif self.players[p].is_dead():
                 raise CantVoteError(self.players[p])
         self.players[p].last_vote = target
-        logger.debug(f'{self.players[p].name} voted {target}')
+        self._count_vote(self.players[p], uncounted)
+        logger.debug('%s voted %s', self.players[p].name, target)
         if self.status == GameStatus.DAY_VOTE:
             votetype = Vote.DAY_VOTE
         elif self.status == GameStatus.NIGHT_VOTE:
@@ -256,11 +571,23 @@ class Game:
                 votetype = Vote.MAFIA_VOTE
             elif self.players[p].role == Role.COP:
                 votetype = Vote.COP_VOTE
+        return p, target, votetype
+
+    def _vote_completes(self, votetype):
+        """did the vote just counted finish its vote, see check_votes"""
+        if votetype == Vote.DAY_VOTE:
+            return not sum(self.pending.values())
+        elif votetype == Vote.MAFIA_VOTE:
+            return not self.pending[Role.MAFIA]
+        return not self.pending[Role.COP]
+
+    def _vote_result(self, p, target, votetype):
+        """execute what a counted vote finished"""
         vote_object = VoteReturnObject(self.players[p],
                                        self.players[target],
                                        votetype,
                                        VoteResult.UNDERWAY)
-        logger.debug(str(vote_object))
+        logger.debug('%s', vote_object)
         consequence = None
         # check if everybody voted
         # in that case, execute the votes
@@ -301,11 +628,7 @@ class Game:
                         vote_object.consequence = consequence
                     self.cycle()
                 else:
-                    still_cops_left = False
-                    for p in self.players:
-                        if p.role == Role.COP and not p.is_dead():
-                            still_cops_left = True
-                    if still_cops_left is False:
+                    if self.alive[Role.COP] == 0:
                         vote_object.voteresult = VoteResult.FINISHED_ALL
                         if votetype == Vote.MAFIA_VOTE:
                             consequence = self.execute_mafia_votes()
@@ -317,50 +640,184 @@ class Game:
         pass
 
     # Utils
+    def has_player(self, ID):
+        return ID in self._player_index
+
+    def index_of(self, ID):
+        """position of the player with this ID in self.players"""
+        try:
+            return self._player_index[ID]
+        except KeyError:
+            # same as list.index for players that didn't join
+            raise ValueError(f'{ID} is not a player')
+
+    def get_player(self, ID):
+        return self.players[self.index_of(ID)]
+
+    def find_player(self, name):
+        """the living player going by name (or something close)"""
+        ids = self.names.find(name)
+        if not ids:
+            raise PlayerNotFoundError(name)
+        if len(ids) > 1:
+            raise AmbiguousPlayerError(
+                name, [self.get_player(ID) for ID in sorted(ids)])
+        return self.get_player(ids.pop())
+
+    def reindex_players(self):
+        # needed whenever self.players gets reordered
+        self._player_index = {p.ID: i for i, p in enumerate(self.players)}
+
     def reset(self):
+        if self._status != GameStatus.NOT_RUNNING:
+            for observer in self.observers:
+                observer.game_ending(self)
         self.status = GameStatus.NOT_RUNNING
         self.players.clear()
-
-    def assign_roles(self):
-        player_total = len(self.players)
-        if player_total < len(Game.MAFIA_AMOUNTS):
-            mafia_total = Game.MAFIA_AMOUNTS[player_total]
-        else:
-            mafia_total = int(Game.MAFIA_RATIO * player_total)
-        if player_total < len(Game.COP_AMOUNTS):
-            cop_total = Game.COP_AMOUNTS[player_total]
+        self._player_index.clear()
+        self._changed(None)
+        self._reset_tallies()
+
+    def _changed(self, players=()):
+        """bump the version, tell the observers whose role/status changed"""
+        # players is None if it could be anybody's
+        self.version += 1
+        for observer in self.observers:
+            observer.players_changed(self, players)
+
+    def _reset_tallies(self):
+        """recount votes from scratch, only needed when the game starts"""
+        # votes of living players, per role of the voter and in total
+        self.tallies = {role: VoteTally() for role in Role}
+        self.day_tally = VoteTally()
+        # living players per role, and how many of them didn't vote yet
+        self.alive = {role: 0 for role in Role}
+        self.pending = {role: 0 for role in Role}
+        self.names = NameIndex()
+        for p in self.players:
+            if p.is_dead():
+                continue
+            self.names.add(p)
+            self.alive[p.role] += 1
+            self.pending[p.role] += 1
+            if p.last_vote is not None:
+                self._count_vote(p)
+
+    def _count_vote(self, player, uncounted=None):
+        # dead people's votes don't count
+        if player.is_dead():
+            return
+        if uncounted is None:
+            self.tallies[player.role].add(player.last_vote)
+            self.day_tally.add(player.last_vote)
         else:
-            cop_total = int(Game.COP_RATIO * player_total)
-        self.mafia_total = mafia_total
-        self.cop_total = cop_total
-        mafia_counter, cop_counter = 0, 0
-
-        # assign mafia
-        if mafia_total > 0:
-            for i in range(0, mafia_total):
-                while mafia_counter < i+1:
-                    r = random.randint(0, player_total - 1)
-                    if self.players[r].role == Role.UNASSIGNED:
-                        self.players[r].role = Role.MAFIA
-                        mafia_counter += 1
-
-        # assign cops
-        if cop_total > 0:
-            for i in range(0, cop_total):
-                while cop_counter < i+1:
-                    r = random.randint(0, player_total - 1)
-                    if self.players[r].role == Role.UNASSIGNED:
-                        self.players[r].role = Role.COP
-                        cop_counter += 1
-
-        # assign villagers
+            # leave the tallies to _count_votes
+            key = (player.role, player.last_vote)
+            uncounted[key] = uncounted.get(key, 0) + 1
+        self.pending[player.role] -= 1
+
+    def _count_votes(self, uncounted):
+        """add up what _count_vote left uncounted"""
+        for (role, target), votes in uncounted.items():
+            self.tallies[role].add(target, votes)
+            self.day_tally.add(target, votes)
+        uncounted.clear()
+
+    def _discount_vote(self, player):
+        self.tallies[player.role].remove(player.last_vote)
+        self.day_tally.remove(player.last_vote)
+        self.pending[player.role] += 1
+
+    def _clear_votes(self, role=None):
+        """forget the votes of everybody (or everybody with this role)"""
+        for observer in self.observers:
+            observer.round_over(self, role)
+        if role is None:
+            # no need to take the votes back one by one
+            for p in self.players:
+                p.last_vote = None
+            self.tallies = {role: VoteTally() for role in Role}
+            self.day_tally = VoteTally()
+            self.pending = dict(self.alive)
+            return
         for p in self.players:
-            if p.role == Role.UNASSIGNED:
-                self.villager_total += 1
-                p.role = Role.VILLAGER
+            if role is not None and p.role != role:
+                continue
+            if p.last_vote is not None and not p.is_dead():
+                self._discount_vote(p)
+            p.last_vote = None
+
+    def game_over(self):
+        """the winning side, or False if the game goes on"""
+        alive_mafia = self.alive[Role.MAFIA]
+        alive_villagers = sum(self.alive.values()) - alive_mafia
+        if not alive_mafia:
+            return Role.VILLAGER
+        if not alive_villagers:
+            return Role.MAFIA
+        return False
+
+    def kill_player(self, player, cause):
+        if player.last_vote is not None:
+            self._discount_vote(player)
+        self.alive[player.role] -= 1
+        self.pending[player.role] -= 1
+        self.names.remove(player)
+        player.kill(cause)
+        self._changed((player,))
 
+    def assign_roles(self):
+        self.apply_roles(self.distribution.roles(len(self.players)))
         logger.debug('Roles assigned.')
 
+    def apply_roles(self, roles):
+        """give players these roles (or role values), in player order"""
+        roles = [Role(role) for role in roles]
+        self.reindex_players()
+        for p, role in zip(self.players, roles):
+            p.role = role
+        self.mafia_total = roles.count(Role.MAFIA)
+        self.cop_total = roles.count(Role.COP)
+        self.villager_total = roles.count(Role.VILLAGER)
+        self._changed(self.players)
+
+    def snapshot(self):
+        """the whole game state as plain data, see restore()"""
+        return {
+            'status': int(self.status),
+            'mafia_vote_finished': self.mafia_vote_finished,
+            'cop_vote_finished': self.cop_vote_finished,
+            'day_vote_finished': self.day_vote_finished,
+            'totals': [self.mafia_total, self.cop_total,
+                       self.villager_total],
+            'players': [[p.ID, p.name, p.role.value, p.status.value,
+                         p.last_vote,
+                         p.death_cause.value if p.death_cause else None,
+                         list(p.aliases)]
+                        for p in self.players],
+        }
+
+    def restore(self, snapshot):
+        self._status = GameStatus(snapshot['status'])
+        self.mafia_vote_finished = snapshot['mafia_vote_finished']
+        self.cop_vote_finished = snapshot['cop_vote_finished']
+        self.day_vote_finished = snapshot['day_vote_finished']
+        self.mafia_total, self.cop_total, self.villager_total = (
+            snapshot['totals'])
+        self.players = []
+        for ID, name, role, status, last_vote, death_cause, aliases in (
+                snapshot['players']):
+            p = Player(ID, name, Role(role), aliases)
+            p._status = PlayerStatus(status)
+            p.last_vote = last_vote
+            if death_cause is not None:
+                p.death_cause = DeathCause(death_cause)
+            self.players.append(p)
+        self.reindex_players()
+        self._reset_tallies()
+        self._changed(None)
+
+    @journaled()
     def cycle(self):
         if self.status == GameStatus.NOT_RUNNING:
             # if the game wasn't running, go directly to NIGHT_TALK
@@ -377,52 +834,27 @@ class Game:
 
     def check_votes(self, what_to_check):
         if what_to_check == Vote.DAY_VOTE:
-            for p in self.players:
-                # dead people dont vote
-                if p.is_dead():
-                    continue
-                elif p.last_vote is None:
-                    # someone alive did not vote yet
-                    return False
-            # everyone alive voted
+            # dead people dont vote, everyone alive has to
+            if sum(self.pending.values()) > 0:
+                return False
             logger.debug('Day votes complete.')
             return True
         elif what_to_check == Vote.MAFIA_VOTE:
-            for p in self.players:
-                # deads and non-mafia don't matter
-                if p.is_dead() or p.role != Role.MAFIA:
-                    continue
-                elif (p.role == Role.MAFIA
-                      and self.mafia_vote_finished is True):
-                    # mafia already voted
-                    continue
-                elif p.last_vote is None:
-                    logger.debug(f'{p.name} didn\'t vote yet.')
-                    # someone alive did not vote yet
-                    return False
-            # everyone alive voted
+            # mafia already voted, or every living mafioso did
+            if not self.mafia_vote_finished and self.pending[Role.MAFIA]:
+                return False
             logger.debug('Mafia votes complete.')
             return True
         elif what_to_check == Vote.COP_VOTE:
-            for p in self.players:
-                # deads and non-cops dont matter
-                if p.is_dead() or p.role != Role.COP:
-                    continue
-                elif (p.role == Role.COP
-                      and self.cop_vote_finished is True):
-                    # cops already voted
-                    continue
-                elif p.last_vote is None:
-                    logger.debug(f'{p.name} didn\'t vote yet.')
-                    # someone alive did not vote yet
-                    return False
-            # everyone alive voted
+            if not self.cop_vote_finished and self.pending[Role.COP]:
+                return False
             logger.debug('Cop votes complete.')
             return True
         else:
             # not a voting scenario
             raise NotVotingScenarioError
 
+    @journaled()
     def execute_votes(self):
         if self.status == GameStatus.DAY_VOTE:
             self.execute_day_votes()
@@ -432,20 +864,12 @@ class Game:
             # not a voting scenario
             raise NotVotingScenarioError
 
+    @journaled()
     def execute_day_votes(self):
         self.day_vote_finished = False
-        voted_players = []
-        # gather all the votes
-        for p in self.players:
-            # dead people don't vote
-            if p.is_dead():
-                continue
-            vote = p.last_vote
-            if vote is not None:
-                voted_players.append(vote)
         # kill the highest voted player, if there is a unique winner
         try:
-            target = self.kill_highest_from_voted(voted_players,
+            target = self.kill_highest_from_voted(self.day_tally,
                                                   DeathCause.VILLAGER_KILL)
         except NoUniqueWinnerError:
             raise NoUniqueWinnerError(Vote.DAY_VOTE)
@@ -457,31 +881,22 @@ class Game:
         finally:
             # clear up votes (even if there was no unique winner)
             # people have to revote
-            for p in self.players:
-                p.last_vote = None
+            self._clear_votes()
             if self.day_vote_finished:
                 return consequence
 
+    @journaled()
     def execute_night_votes(self):
         self.execute_mafia_votes()
         self.execute_cop_votes()
         logger.debug('Night votes executed.')
 
+    @journaled()
     def execute_mafia_votes(self):
-        voted_players = []
-        # gather all the votes
-        for p in self.players:
-            # only check mafia players' votes
-            if p.is_dead() or p.role != Role.MAFIA:
-                continue
-            vote = p.last_vote
-            if vote is not None:
-                logger.debug(f'vote counted:{p.name} voted {vote}')
-                voted_players.append(vote)
         # kill the highest voted player, if there is a unique winner
         self.mafia_vote_finished = False
         try:
-            target = self.kill_highest_from_voted(voted_players,
+            target = self.kill_highest_from_voted(self.tallies[Role.MAFIA],
                                                   DeathCause.MAFIA_KILL)
         except NoUniqueWinnerError:
             raise NoUniqueWinnerError(Vote.MAFIA_VOTE)
@@ -492,27 +907,16 @@ class Game:
         finally:
             # clear up votes (even if there was no unique winner)
             # people have to revote
-            for p in self.players:
-                logger.debug(f'{p.name} role = {p.role}')
-                if p.role == Role.MAFIA:
-                    p.last_vote = None
+            self._clear_votes(Role.MAFIA)
             if self.mafia_vote_finished is True:
                 return consequence
 
+    @journaled()
     def execute_cop_votes(self):
-        voted_players = []
-        # gather all the votes
-        for p in self.players:
-            # only check cop players' votes
-            if p.is_dead() or p.role != Role.COP:
-                continue
-            vote = p.last_vote
-            if vote is not None:
-                logger.debug(f'vote counted:{p.name} voted {vote}')
-                voted_players.append(vote)
         self.cop_vote_finished = False
         try:
-            target = self.players[self.get_most_common_vote(voted_players)]
+            target = self.players[
+                self.tallies[Role.COP].winner(len(self.players))]
             # TODO
             pass
         except NoUniqueWinnerError:
@@ -523,21 +927,19 @@ class Game:
         finally:
             # clear up votes (even if there was no unique winner)
             # people have to revote
-            for p in self.players:
-                if p.role == Role.COP:
-                    p.last_vote = None
+            self._clear_votes(Role.COP)
             if self.cop_vote_finished:
                 return consequence
 
-    def kill_highest_from_voted(self, voted_players, kill_cause):
-        # count the votes
-        win_i = self.get_most_common_vote(voted_players)
+    def kill_highest_from_voted(self, tally, kill_cause):
+        # the tally already counted the votes
+        win_i = tally.winner(len(self.players))
         if win_i is not False:
             # there was a unique vote
             # so we can kill someone, yay!
             winner = self.players[win_i]
             if not winner.is_dead():
-                winner.kill(kill_cause)
+                self.kill_player(winner, kill_cause)
             else:
                 raise WinnerAlreadyDeadError(winner)
             return winner
@@ -546,18 +948,7 @@ class Game:
             raise NoUniqueWinnerError
 
     def get_most_common_vote(self, votes):
-        vote_count = [0] * len(self.players)
-        logger.debug(str(votes))
-        for i, v in enumerate(votes):
-            vote_count[v] += 1
-            logger.debug(f'{i}, {v},{vote_count}')
-        highest_i, max = 0, 0
-        for i, v in enumerate(vote_count):
-            if v > max:
-                highest_i = i
-                max = v
-        for i, v in enumerate(vote_count):
-            if v == max and i != highest_i:
-                # there were at least 2 highest votes
-                return False
-        return highest_i
+        tally = VoteTally()
+        for v in votes:
+            tally.add(v)
+        return tally.winner(len(self.players))
@@ -0,0 +1,241 @@
+"""Headless simulator and throughput benchmark for mafia.Game.
+
+Plays whole games without Discord: players join, the game starts and
+everybody votes (scripted or at random) until one side won. Reports
+games/sec, votes/sec, latency percentiles of the engine calls and,
+with --trace-alloc, memory allocations. With --history the games go
+into a mafia_history archive.
+
+    python mafia_bench.py --players 5 9 --games 2000 --strategy random
+"""
+import time
+import random
+import argparse
+import tracemalloc
+
+import mafia
+from mafia_history import GameRecorder, HistoryArchive
+
+# give up on a phase after this many rounds without a result,
+# like the bot's timer would
+MAX_VOTE_ROUNDS = 3
+# and on a game after this many phases
+MAX_PHASES = 200
+
+
+def random_target(game, voter, rng):
+    """anybody alive except themselves (mafia don't vote mafia)"""
+    targets = [p for p in game.players
+               if not p.is_dead() and p is not voter and
+               not (voter.role == mafia.Role.MAFIA and
+                    p.role == mafia.Role.MAFIA)]
+    return rng.choice(targets) if targets else voter
+
+
+def scripted_target(game, voter, rng):
+    """everybody agrees on the first living player they could vote for"""
+    for p in game.players:
+        if p.is_dead() or p is voter:
+            continue
+        if voter.role == mafia.Role.MAFIA and p.role == mafia.Role.MAFIA:
+            continue
+        return p
+    return voter
+
+
+STRATEGIES = {
+    'random': random_target,
+    'scripted': scripted_target,
+}
+
+
+class Stats():
+    def __init__(self):
+        self.games = 0
+        self.votes = 0
+        self.vote_errors = 0
+        self.phases = 0
+        self.timeouts = 0
+        self.winners = {mafia.Role.VILLAGER: 0, mafia.Role.MAFIA: 0}
+        # call name -> list of durations in ns
+        self.latencies = {'start': [], 'vote_user': [], 'vote_users': [],
+                          'cycle': []}
+
+    def timed(self, name, func, *args):
+        started = time.perf_counter_ns()
+        try:
+            return func(*args)
+        finally:
+            self.latencies[name].append(time.perf_counter_ns() - started)
+
+
+def voters(game):
+    """who can vote in the current phase"""
+    if game.status == mafia.GameStatus.DAY_VOTE:
+        return [p for p in game.players if not p.is_dead()]
+    result = []
+    for p in game.players:
+        if p.is_dead() or p.last_vote is not None:
+            continue
+        if p.role == mafia.Role.MAFIA and not game.mafia_vote_finished:
+            result.append(p)
+        elif p.role == mafia.Role.COP and not game.cop_vote_finished:
+            result.append(p)
+    return result
+
+
+def play_phase(game, choose, rng, stats, bulk=False):
+    """vote until the phase is over, cycle like the timer if it isn't"""
+    status = game.status
+    for _ in range(MAX_VOTE_ROUNDS):
+        if bulk:
+            # the whole round in one call
+            votes = [(voter.ID, choose(game, voter, rng).ID)
+                     for voter in voters(game)]
+            stats.votes += len(votes)
+            batch = stats.timed('vote_users', game.vote_users, votes)
+            stats.vote_errors += len(batch.errors)
+            if game.status != status or game.game_over():
+                return
+            continue
+        for voter in voters(game):
+            target = choose(game, voter, rng)
+            stats.votes += 1
+            try:
+                stats.timed('vote_user', game.vote_user, voter.ID, target.ID)
+            except mafia.Error:
+                stats.vote_errors += 1
+            if game.status != status or game.game_over():
+                return
+    # time ran out
+    stats.timeouts += 1
+    if (game.status == mafia.GameStatus.NIGHT_VOTE and
+            game.mafia_vote_finished):
+        try:
+            game.execute_mafia_votes()
+        except mafia.Error:
+            stats.vote_errors += 1
+    stats.timed('cycle', game.cycle)
+
+
+def play_game(player_total, choose, rng, stats, distribution=None,
+              bulk=False, archive=None):
+    game = mafia.Game(distribution)
+    if archive is not None:
+        GameRecorder(game, archive)
+    for i in range(player_total):
+        game.join(i, f'player{i}')
+    stats.timed('start', game.start)
+    phases = 0
+    while not game.game_over() and phases < MAX_PHASES:
+        play_phase(game, choose, rng, stats, bulk)
+        phases += 1
+    stats.phases += phases
+    stats.games += 1
+    winner = game.game_over()
+    if winner:
+        stats.winners[winner] += 1
+    if archive is not None:
+        # ending the game archives it
+        game.stop()
+    return game
+
+
+def percentiles(values, points=(50, 90, 99)):
+    if not values:
+        return {}
+    values = sorted(values)
+    result = {p: values[min(len(values) - 1, len(values) * p // 100)]
+              for p in points}
+    result['max'] = values[-1]
+    return result
+
+
+def run_benchmark(player_total, games, strategy='random', seed=None,
+                  trace_alloc=False, bulk=False, archive=None):
+    """play games with player_total players each, returns a report dict"""
+    rng = random.Random(seed)
+    distribution = mafia.RoleDistribution(seed=seed)
+    choose = STRATEGIES[strategy]
+    stats = Stats()
+    if trace_alloc:
+        tracemalloc.start()
+    started = time.perf_counter()
+    for _ in range(games):
+        play_game(player_total, choose, rng, stats, distribution, bulk,
+                  archive)
+    elapsed = time.perf_counter() - started
+    report = {
+        'players': player_total,
+        'games': stats.games,
+        'seconds': elapsed,
+        'games_per_sec': stats.games / elapsed if elapsed else 0,
+        'votes_per_sec': stats.votes / elapsed if elapsed else 0,
+        'votes': stats.votes,
+        'vote_errors': stats.vote_errors,
+        'phases': stats.phases,
+        'timeouts': stats.timeouts,
+        'mafia_wins': stats.winners[mafia.Role.MAFIA],
+        'villager_wins': stats.winners[mafia.Role.VILLAGER],
+        'latency_ns': {name: percentiles(values)
+                       for name, values in stats.latencies.items()},
+    }
+    if trace_alloc:
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        stat_total = sum(stat.count for stat in snapshot.statistics('lineno'))
+        report['alloc_peak_bytes'] = peak
+        report['alloc_live_bytes'] = current
+        report['alloc_live_blocks'] = stat_total
+    return report
+
+
+def print_report(report):
+    print(f"{report['players']} players, {report['games']} games "
+          f"in {report['seconds']:.2f}s")
+    print(f"    {report['games_per_sec']:.1f} games/s, "
+          f"{report['votes_per_sec']:.0f} votes/s "
+          f"({report['votes']} votes, {report['vote_errors']} rejected, "
+          f"{report['timeouts']} timeouts)")
+    print(f"    mafia won {report['mafia_wins']}, "
+          f"villagers won {report['villager_wins']}")
+    for name, points in report['latency_ns'].items():
+        if points:
+            print(f'    {name:>9}: ' + ', '.join(
+                f'p{p}={ns / 1000:.1f}us' if p != 'max' else
+                f'max={ns / 1000:.1f}us' for p, ns in points.items()))
+    if 'alloc_peak_bytes' in report:
+        print(f"    allocations: peak {report['alloc_peak_bytes']} bytes, "
+              f"{report['alloc_live_bytes']} bytes in "
+              f"{report['alloc_live_blocks']} blocks still live")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--players', type=int, nargs='+', default=[5, 9],
+                        help='lobby sizes to simulate')
+    parser.add_argument('--games', type=int, default=1000,
+                        help='games per lobby size')
+    parser.add_argument('--strategy', choices=STRATEGIES, default='random')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--trace-alloc', action='store_true',
+                        help='track allocations (slows everything down)')
+    parser.add_argument('--bulk', action='store_true',
+                        help='cast the votes of a round with vote_users')
+    parser.add_argument('--history', metavar='DIRECTORY',
+                        help='archive the games there, see mafia_history')
+    args = parser.parse_args()
+    archive = None
+    if args.history:
+        archive = HistoryArchive(args.history, buffered=1000)
+    for player_total in args.players:
+        print_report(run_benchmark(player_total, args.games, args.strategy,
+                                   args.seed, args.trace_alloc, args.bulk,
+                                   archive))
+    if archive is not None:
+        archive.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,389 @@
+"""Archive of finished games, kept column by column, and what it adds up to.
+
+A GameRecorder watches a game (it's a mafia.GameObserver) and hands a
+GameRecord to a HistoryArchive when the game ends: the roles, who died
+in which order, of what and in which phase, every round of votes and
+how long each phase took.
+
+The archive is a directory with one file per column, each a flat array
+of fixed size numbers (see the array module) that only ever gets
+appended to. A game takes a few dozen bytes, and loading a column of
+millions of games is one read. The aggregates work on whole columns.
+
+    python mafia_history.py <directory>
+
+prints win rates by lobby size and by number of phases, and what
+people died of.
+"""
+import os
+import time
+import array
+import bisect
+import logging
+import argparse
+from itertools import compress, accumulate
+from collections import Counter
+
+import mafia
+
+logger = logging.getLogger(__name__)
+
+# table -> (column, array typecode)
+TABLES = {
+    # one row per game
+    'games': (('players', 'H'), ('winner', 'b'), ('phases', 'H'),
+              ('rounds', 'H'), ('ended', 'd')),
+    # one row per player, in the order they joined
+    'players': (('game', 'I'), ('role', 'b'), ('death', 'h'),
+                ('cause', 'b'), ('death_phase', 'h')),
+    # one row per round of votes
+    'rounds': (('game', 'I'), ('phase', 'H'), ('voters', 'b')),
+    # one row per player and round: who they voted for, -1 if nobody
+    'votes': (('target', 'h'),),
+    # one row per phase
+    'phases': (('game', 'I'), ('status', 'b'), ('seconds', 'f')),
+}
+# games.winner if the game got stopped before anybody won
+NO_WINNER = 0
+# rounds.voters of day votes, night votes have the voters' role value
+EVERYBODY = 0
+
+
+class GameRecord():
+    """what happened in one game, see GameRecorder"""
+
+    def __init__(self, roles):
+        self.roles = roles  # role values, in player order
+        self.deaths = []  # (player index, DeathCause value, phase)
+        self.rounds = []  # (phase, voters, target index per player)
+        self.phases = []  # (GameStatus value, seconds)
+        self.winner = NO_WINNER
+        self.ended = None
+
+    def died(self, index, cause):
+        if all(death[0] != index for death in self.deaths):
+            self.deaths.append((index, cause.value if cause else -1,
+                                len(self.phases)))
+
+
+class GameRecorder(mafia.GameObserver):
+    """records a game into archive as it goes"""
+
+    def __init__(self, game, archive, clock=time.monotonic):
+        self.archive = archive
+        self.clock = clock
+        self.record = None
+        self.status = game.status
+        self.since = clock()
+        game.observers.append(self)
+
+    def players_changed(self, game, players):
+        if game.status != self.status:
+            self.phase_changed(game)
+        if players is None and self.record is None:
+            # restored, e.g. from a journal: start from what we've got
+            if game.status != mafia.GameStatus.NOT_RUNNING:
+                self.record = GameRecord([p.role.value
+                                          for p in game.players])
+        if self.record is None:
+            return
+        for p in (game.players if players is None else players):
+            if p.is_dead():
+                self.record.died(game.index_of(p.ID), p.death_cause)
+
+    def phase_changed(self, game):
+        now = self.clock()
+        if self.record is not None:
+            self.record.phases.append((int(self.status), now - self.since))
+        elif game.status != mafia.GameStatus.NOT_RUNNING:
+            self.record = GameRecord([p.role.value for p in game.players])
+        self.status, self.since = game.status, now
+
+    def round_over(self, game, role):
+        if self.record is None:
+            return
+        targets = [p.last_vote if (p.last_vote is not None and
+                                   (role is None or p.role == role))
+                   else -1 for p in game.players]
+        if any(target != -1 for target in targets):
+            self.record.rounds.append((len(self.record.phases),
+                                       EVERYBODY if role is None
+                                       else role.value, targets))
+
+    def game_ending(self, game):
+        if self.record is None:
+            return
+        record, self.record = self.record, None
+        record.phases.append((int(self.status), self.clock() - self.since))
+        winner = game.game_over()
+        record.winner = winner.value if winner else NO_WINNER
+        record.ended = time.time()
+        try:
+            self.archive.append(record)
+        except OSError:
+            # losing the history is no reason to break the game
+            logger.exception('Failed to archive a game.')
+
+
+class HistoryArchive():
+    """the finished games in directory path, see the module docstring
+
+    Appended games are kept in memory until there are buffered of them,
+    use flush() (or close()) to write the rest.
+    """
+
+    def __init__(self, path, buffered=1):
+        self.path = path
+        self.buffered = buffered
+        os.makedirs(path, exist_ok=True)
+        self.pending = self.empty()
+        self.pending_games = 0
+        self.stored = self.repair()
+
+    @staticmethod
+    def empty():
+        return {table: {column: array.array(typecode)
+                        for column, typecode in columns}
+                for table, columns in TABLES.items()}
+
+    def file(self, table, column):
+        return os.path.join(self.path, f'{table}.{column}')
+
+    def rows(self, table, column, typecode):
+        try:
+            size = os.path.getsize(self.file(table, column))
+        except FileNotFoundError:
+            return 0
+        return size // array.array(typecode).itemsize
+
+    def count(self, table):
+        """rows of table on disk, the ones all its columns have"""
+        return min(self.rows(table, column, typecode)
+                   for column, typecode in TABLES[table])
+
+    def truncate(self, table, rows):
+        for column, typecode in TABLES[table]:
+            path = self.file(table, column)
+            size = rows * array.array(typecode).itemsize
+            # even half a row too much, or the next ones would be misread
+            if os.path.exists(path) and os.path.getsize(path) > size:
+                os.truncate(path, size)
+
+    def repair(self):
+        """cut off what a crash in the middle of flush() left behind
+
+        Keeps the games that have all their rows in every table (the
+        games table says how many each needs) and drops the rest.
+        Returns the number of games kept.
+        """
+        games = self.load('games', flush=False)
+        # rounds of games that didn't make it into games count as missing
+        round_games = self.load('rounds', flush=False)['game']
+        round_games = round_games[:bisect.bisect_left(
+            round_games, len(games['players']))]
+        # rows a table needs for the first n games, at index n
+        needed = {table: [0, *accumulate(games[table])]
+                  for table in ('players', 'rounds', 'phases')}
+        # rows votes needs for the first n rounds
+        votes = [0, *accumulate(games['players'][game]
+                                for game in round_games)]
+        rows = {table: self.count(table) for table in TABLES}
+
+        rows['rounds'] = min(rows['rounds'], len(round_games))
+
+        def complete(n):
+            return (all(needed[table][n] <= rows[table]
+                        for table in needed) and
+                    votes[needed['rounds'][n]] <= rows['votes'])
+
+        # complete(n) holds up to some n, find the last one
+        low, high = 0, rows['games']
+        while low < high:
+            middle = (low + high + 1) // 2
+            if complete(middle):
+                low = middle
+            else:
+                high = middle - 1
+        self.truncate('games', low)
+        for table in needed:
+            self.truncate(table, needed[table][low])
+        self.truncate('votes', votes[needed['rounds'][low]])
+        return low
+
+    def append(self, record):
+        game = self.stored + self.pending_games
+        columns = self.pending
+        n = len(record.roles)
+        games = columns['games']
+        games['players'].append(n)
+        games['winner'].append(record.winner)
+        games['phases'].append(len(record.phases))
+        games['rounds'].append(len(record.rounds))
+        games['ended'].append(record.ended or 0.0)
+        deaths = {index: (order, cause, phase) for order, (
+            index, cause, phase) in enumerate(record.deaths)}
+        players = columns['players']
+        for index, role in enumerate(record.roles):
+            order, cause, phase = deaths.get(index, (-1, -1, -1))
+            players['game'].append(game)
+            players['role'].append(role)
+            players['death'].append(order)
+            players['cause'].append(cause)
+            players['death_phase'].append(phase)
+        rounds = columns['rounds']
+        for phase, voters, targets in record.rounds:
+            rounds['game'].append(game)
+            rounds['phase'].append(phase)
+            rounds['voters'].append(voters)
+            columns['votes']['target'].extend(targets)
+        phases = columns['phases']
+        for status, seconds in record.phases:
+            phases['game'].append(game)
+            phases['status'].append(status)
+            phases['seconds'].append(seconds)
+        self.pending_games += 1
+        if self.pending_games >= self.buffered:
+            self.flush()
+
+    def flush(self):
+        if not self.pending_games:
+            return
+        try:
+            for table, columns in self.pending.items():
+                for column, values in columns.items():
+                    with open(self.file(table, column), 'ab') as f:
+                        values.tofile(f)
+        except OSError:
+            # drop what made it, the next flush writes it all again
+            self.repair()
+            raise
+        self.stored += self.pending_games
+        self.pending = self.empty()
+        self.pending_games = 0
+
+    def close(self):
+        self.flush()
+
+    def load(self, table, flush=True):
+        """{column: array} of all rows of table"""
+        if flush:
+            self.flush()
+        rows = self.count(table)
+        columns = {}
+        for column, typecode in TABLES[table]:
+            values = array.array(typecode)
+            try:
+                with open(self.file(table, column), 'rb') as f:
+                    # a column might be longer, see repair()
+                    values.fromfile(f, rows)
+            except FileNotFoundError:
+                pass
+            columns[column] = values
+        return columns
+
+    def __len__(self):
+        return self.stored + self.pending_games
+
+    # Aggregates
+
+    def win_rates(self, by='players'):
+        """{games.<by>: (games, villager wins, mafia wins)}"""
+        games = self.load('games')
+        keys = games[by]
+        totals = Counter(keys)
+        wins = Counter(zip(keys, games['winner']))
+        villager, mafioso = mafia.Role.VILLAGER.value, mafia.Role.MAFIA.value
+        return {key: (total, wins[key, villager], wins[key, mafioso])
+                for key, total in sorted(totals.items())}
+
+    def death_causes(self):
+        """{(role, DeathCause value): deaths}, -1 as cause for survivors"""
+        players = self.load('players')
+        return pair_counts(players['role'], players['cause'])
+
+    def phase_seconds(self):
+        """{GameStatus value: (phases, mean seconds)}"""
+        phases = self.load('phases')
+        statuses = phases['status'].tobytes()
+        result = {}
+        for key, count in sorted(byte_counts(statuses).items()):
+            # 1 where the phase had this status, 0 elsewhere
+            mask = statuses.translate(bytes(int(value == key)
+                                            for value in range(256)))
+            total = sum(compress(phases['seconds'], mask))
+            result[signed(key)] = (count, total / count)
+        return result
+
+
+# Column operations, done by C loops over whole 'b' columns (bytes) rather
+# than a Python loop per row
+
+def signed(byte):
+    return byte - 256 if byte > 127 else byte
+
+
+def byte_counts(data):
+    """{byte: how often it's in data}"""
+    return {value: data.count(value) for value in set(data)}
+
+
+def pair_counts(first, second):
+    """{(first[i], second[i]): rows} of two 'b' columns
+
+    As long as first * width + second fits in a byte for every row, it
+    gets computed for all rows at once with big integer arithmetic (no
+    byte carries into the next) and counted with byte_counts.
+    """
+    # -1 -> 0, 0 -> 1, ... so there's nothing negative
+    shift = bytes(range(1, 256)) + b'\0'
+    first = first.tobytes().translate(shift)
+    second = second.tobytes().translate(shift)
+    if not first:
+        return {}
+    width = max(second) + 1
+    if (max(first) + 1) * width > 256:
+        return dict(sorted(Counter(zip(map(signed, first),
+                                       map(signed, second))).items()))
+    keys = (int.from_bytes(first, 'little') * width +
+            int.from_bytes(second, 'little')).to_bytes(len(first), 'little')
+    return {(key // width - 1, key % width - 1): count
+            for key, count in sorted(byte_counts(keys).items())}
+
+
+def format_win_rates(rates, label):
+    lines = [f'{label:>8} {"games":>10} {"villagers":>10} {"mafia":>10}']
+    for key, (total, villager, mafioso) in rates.items():
+        lines.append(f'{key:>8} {total:>10} {villager / total:>10.1%} '
+                     f'{mafioso / total:>10.1%}')
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('directory', help='the HISTORY_DIR of the bot')
+    args = parser.parse_args()
+    if not os.path.isdir(args.directory):
+        parser.error(f'{args.directory} is not a directory')
+    archive = HistoryArchive(args.directory)
+    started = time.perf_counter()
+    by_players = archive.win_rates('players')
+    by_phases = archive.win_rates('phases')
+    causes = archive.death_causes()
+    phases = archive.phase_seconds()
+    took = time.perf_counter() - started
+    print(f'{len(archive)} games, added up in {took:.2f}s\n')
+    print(format_win_rates(by_players, 'players') + '\n')
+    print(format_win_rates(by_phases, 'phases') + '\n')
+    print('deaths')
+    for (role, cause), count in causes.items():
+        cause = (mafia.DeathCause(cause).name if cause >= 0
+                 else 'SURVIVED')
+        print(f'    {mafia.Role(role).name:>10} {cause:>14} {count:>10}')
+    print('\nphases')
+    for status, (count, mean) in phases.items():
+        print(f'    {mafia.GameStatus(status).name:>11} {count:>10} '
+              f'{mean:>10.2f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""Append-only journal of mafia.Game state changes, for crash recovery.
+
+Every journaled Game call (join, start with its roles, vote_user, cycle,
+executing votes, stop) gets appended to <name>.log as one JSON line.
+The file is fsynced every sync_every records. Every snapshot_every
+records, the whole game is written to <name>.snap and the log starts
+over, so recovering a game means loading one snapshot and replaying a
+short tail.
+"""
+import os
+import json
+import logging
+
+import mafia
+
+logger = logging.getLogger(__name__)
+
+SYNC_EVERY = 16
+SNAPSHOT_EVERY = 256
+
+
+class Journal():
+    def __init__(self, path, sync_every=SYNC_EVERY,
+                 snapshot_every=SNAPSHOT_EVERY):
+        """path is the journal's name without extension"""
+        self.path = path
+        self.log_path = path + '.log'
+        self.snap_path = path + '.snap'
+        self.sync_every = sync_every
+        self.snapshot_every = snapshot_every
+        self.seq = 0
+        self.unsynced = 0
+        self.since_snapshot = 0
+        self.file = None
+
+    def open(self):
+        if self.file is None:
+            self.file = open(self.log_path, 'a', encoding='utf-8')
+
+    def attach(self, game):
+        """start journaling game"""
+        self.open()
+        game.journal = self
+        return game
+
+    def record(self, game, event, args):
+        self.seq += 1
+        self.file.write(json.dumps([self.seq, event, list(args)],
+                                   separators=(',', ':')) + '\n')
+        self.unsynced += 1
+        self.since_snapshot += 1
+        if self.since_snapshot >= self.snapshot_every:
+            self.snapshot(game)
+        elif self.unsynced >= self.sync_every:
+            self.sync()
+
+    def sync(self):
+        if self.file is not None and self.unsynced:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.unsynced = 0
+
+    def snapshot(self, game):
+        """write the whole game, then start the log over"""
+        tmp_path = self.snap_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'seq': self.seq, 'game': game.snapshot()}, f,
+                      separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snap_path)
+        # everything in the log is in the snapshot now
+        # (if we crash before this, recovery skips those records)
+        self.file.truncate(0)
+        self.file.seek(0)
+        self.unsynced = 0
+        self.since_snapshot = 0
+        logger.debug('Snapshot of %s at %d.', self.path, self.seq)
+
+    def recover(self, game=None):
+        """rebuild the game from snapshot and log, then keep journaling it"""
+        if game is None:
+            game = mafia.Game()
+        game.journal = None
+        if os.path.exists(self.snap_path):
+            with open(self.snap_path, encoding='utf-8') as f:
+                snapshot = json.load(f)
+            game.restore(snapshot['game'])
+            self.seq = snapshot['seq']
+        replayed = 0
+        # runs of votes get replayed together, see Game.vote_users
+        votes = []
+        if os.path.exists(self.log_path):
+            with open(self.log_path, 'rb+') as f:
+                good = 0
+                for line in f:
+                    try:
+                        if not line.endswith(b'\n'):
+                            raise ValueError
+                        seq, event, args = json.loads(line)
+                    except ValueError:
+                        # torn write at the end, that call never finished
+                        # cut it off so new records don't end up behind it
+                        f.truncate(good)
+                        break
+                    good += len(line)
+                    if seq <= self.seq:
+                        continue
+                    self.seq = seq
+                    replayed += 1
+                    if event == 'vote_user' and len(args) == 2:
+                        votes.append(args)
+                        continue
+                    self.replay(game, votes, event, args)
+        self.replay(game, votes)
+        self.since_snapshot = replayed
+        logger.debug('Recovered %s, replayed %d records.', self.path,
+                     replayed)
+        return self.attach(game)
+
+    def replay(self, game, votes, event=None, args=()):
+        """cast the collected votes, then replay event"""
+        if votes:
+            # failed votes end up in the batch's errors, no harm done
+            game.vote_users(votes)
+            votes.clear()
+        if event is None:
+            return
+        try:
+            getattr(game, event)(*args)
+        except mafia.Error:
+            # it failed the first time round as well
+            pass
+
+    def close(self, remove=False):
+        """stop journaling, and forget everything if remove"""
+        if self.file is not None:
+            self.sync()
+            self.file.close()
+            self.file = None
+        if remove:
+            for path in (self.log_path, self.snap_path):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def exists(self):
+        return (os.path.exists(self.log_path) or
+                os.path.exists(self.snap_path))
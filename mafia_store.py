@@ -0,0 +1,330 @@
+"""Shared storage for game state, so several bot workers can serve games.
+
+Every game lives under a key (see GameRegistry.journal_name) together
+with the worker that owns it, how long that worker's lease lasts and a
+version. A worker has to claim a game before it can save it, leases run
+out if the worker dies, so another worker can take over the game. Saves
+only go through if nobody else saved in the meantime (optimistic
+locking), otherwise the worker has to load the game again.
+
+SQLiteStore keeps everything in one SQLite database in WAL mode, so
+workers on one machine can share it. Loading and saving a game run on
+the event loop (the Game calls that save aren't coroutines), so they
+stall it while another worker writes, but never longer than
+BUSY_TIMEOUT_SEC: then the game counts as theirs for the moment
+(NotOwnerError) and the change gets rolled back, see StoreJournal.
+Only renewing the leases (GameRegistry.renew_leases) runs in an
+executor, on a connection of its own.
+MemoryStore does the same in memory, which only one process can see:
+it's for tests and tools, never for several workers.
+"""
+import contextlib
+import json
+import time
+import sqlite3
+import logging
+import threading
+
+import mafia
+
+logger = logging.getLogger(__name__)
+
+LEASE_SEC = 30.0
+# how long to wait for another worker's write before giving up
+BUSY_TIMEOUT_SEC = 0.2
+
+
+class StoreError(mafia.Error):
+    """Base class for state store errors"""
+
+
+class NotOwnerError(StoreError):
+    """Raised when another worker holds the lease of a game
+
+    until is when their lease runs out, no use trying again before.
+    """
+    def __init__(self, key=None, owner=None, until=None, context=None):
+        self.context = context
+        self.key = key
+        self.owner = owner
+        self.until = until
+
+
+class StaleStateError(StoreError):
+    """Raised when somebody else saved the game since we loaded it"""
+    def __init__(self, key=None, context=None):
+        self.context = context
+        self.key = key
+
+
+class StateStore():
+    """what a state store has to do, see SQLiteStore and MemoryStore"""
+
+    def claim(self, key, owner, lease=LEASE_SEC):
+        """own key for lease seconds, raises NotOwnerError if we can't"""
+        raise NotImplementedError
+
+    def renew(self, keys, owner, lease=LEASE_SEC):
+        """extend the leases of the keys owner still has, returns those"""
+        raise NotImplementedError
+
+    def release(self, key, owner):
+        """let other workers take over key right away"""
+        raise NotImplementedError
+
+    def load(self, key):
+        """(version, snapshot) of key, (0, None) if nothing was saved"""
+        raise NotImplementedError
+
+    def save(self, key, owner, snapshot, version):
+        """store snapshot if key is still at version, returns the new one"""
+        raise NotImplementedError
+
+    def delete(self, key, owner):
+        raise NotImplementedError
+
+    def keys(self):
+        """keys that have a saved game"""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class SQLiteStore(StateStore):
+    def __init__(self, path, timeout=BUSY_TIMEOUT_SEC):
+        self.path = path
+        # workers are processes, but one process might use threads
+        self.db = sqlite3.connect(path, timeout=timeout,
+                                  check_same_thread=False,
+                                  isolation_level=None)
+        self.lock = threading.Lock()
+        # readers don't block the writer and the other way round
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        # renew() runs in another thread, on its own connection so it
+        # never holds self.lock while it waits for the database
+        self.renew_db = sqlite3.connect(path, timeout=timeout,
+                                        check_same_thread=False,
+                                        isolation_level=None)
+        self.renew_lock = threading.Lock()
+        self.db.execute('CREATE TABLE IF NOT EXISTS games ('
+                        'key TEXT PRIMARY KEY, '
+                        'owner TEXT, '
+                        'lease_until REAL NOT NULL DEFAULT 0, '
+                        'version INTEGER NOT NULL DEFAULT 0, '
+                        'state TEXT)')
+
+    @contextlib.contextmanager
+    def locked(self, key):
+        """self.lock, while another worker writes key counts as theirs"""
+        with self.lock:
+            try:
+                yield
+            except sqlite3.OperationalError as err:
+                if 'locked' not in str(err):
+                    raise
+                raise NotOwnerError(
+                    key, None, time.time() + BUSY_TIMEOUT_SEC) from err
+
+    def claim(self, key, owner, lease=LEASE_SEC):
+        now = time.time()
+        with self.locked(key):
+            self.db.execute('INSERT OR IGNORE INTO games (key) VALUES (?)',
+                            (key,))
+            claimed = self.db.execute(
+                'UPDATE games SET owner = ?, lease_until = ? '
+                'WHERE key = ? AND '
+                '(owner IS NULL OR owner = ? OR lease_until < ?)',
+                (owner, now + lease, key, owner, now)).rowcount
+            if not claimed:
+                row = self.db.execute('SELECT owner, lease_until FROM games '
+                                      'WHERE key = ?', (key,)).fetchone()
+                raise NotOwnerError(key, row[0], row[1])
+
+    def renew(self, keys, owner, lease=LEASE_SEC):
+        renewed = []
+        with self.renew_lock:
+            self.renew_db.execute('BEGIN IMMEDIATE')
+            try:
+                for key in keys:
+                    if self.renew_db.execute(
+                            'UPDATE games SET lease_until = ? '
+                            'WHERE key = ? AND owner = ?',
+                            (time.time() + lease, key, owner)).rowcount:
+                        renewed.append(key)
+            finally:
+                self.renew_db.execute('COMMIT')
+        return renewed
+
+    def release(self, key, owner):
+        with self.locked(key):
+            self.db.execute('UPDATE games SET owner = NULL, lease_until = 0 '
+                            'WHERE key = ? AND owner = ?', (key, owner))
+
+    def load(self, key):
+        with self.locked(key):
+            row = self.db.execute('SELECT version, state FROM games '
+                                  'WHERE key = ?', (key,)).fetchone()
+        if row is None or row[1] is None:
+            return (row[0] if row else 0), None
+        return row[0], json.loads(row[1])
+
+    def save(self, key, owner, snapshot, version):
+        state = json.dumps(snapshot, separators=(',', ':'))
+        with self.locked(key):
+            saved = self.db.execute(
+                'UPDATE games SET state = ?, version = version + 1 '
+                'WHERE key = ? AND owner = ? AND version = ?',
+                (state, key, owner, version)).rowcount
+        if not saved:
+            raise StaleStateError(key)
+        return version + 1
+
+    def delete(self, key, owner):
+        with self.locked(key):
+            self.db.execute('DELETE FROM games WHERE key = ? AND owner = ?',
+                            (key, owner))
+
+    def keys(self):
+        with self.lock:
+            return [row[0] for row in self.db.execute(
+                'SELECT key FROM games WHERE state IS NOT NULL')]
+
+    def close(self):
+        with self.renew_lock:
+            self.renew_db.close()
+        with self.lock:
+            self.db.close()
+
+
+class MemoryStore(StateStore):
+    """a StateStore for one process only, e.g. tests and tools"""
+
+    def __init__(self):
+        self.games = {}  # key -> [owner, lease_until, version, snapshot]
+        self.lock = threading.Lock()
+
+    def claim(self, key, owner, lease=LEASE_SEC):
+        now = time.time()
+        with self.lock:
+            game = self.games.setdefault(key, [None, 0, 0, None])
+            if game[0] not in (None, owner) and game[1] >= now:
+                raise NotOwnerError(key, game[0], game[1])
+            game[0], game[1] = owner, now + lease
+
+    def renew(self, keys, owner, lease=LEASE_SEC):
+        renewed = []
+        with self.lock:
+            for key in keys:
+                game = self.games.get(key)
+                if game is not None and game[0] == owner:
+                    game[1] = time.time() + lease
+                    renewed.append(key)
+        return renewed
+
+    def release(self, key, owner):
+        with self.lock:
+            game = self.games.get(key)
+            if game is not None and game[0] == owner:
+                game[0], game[1] = None, 0
+
+    def load(self, key):
+        with self.lock:
+            game = self.games.get(key)
+            if game is None:
+                return 0, None
+            # a copy, like reading it from somewhere else would be
+            return game[2], json.loads(json.dumps(game[3]))
+
+    def save(self, key, owner, snapshot, version):
+        with self.lock:
+            game = self.games.get(key)
+            if game is None or game[0] != owner or game[2] != version:
+                raise StaleStateError(key)
+            game[2] += 1
+            game[3] = json.loads(json.dumps(snapshot))
+            return game[2]
+
+    def delete(self, key, owner):
+        with self.lock:
+            game = self.games.get(key)
+            if game is not None and game[0] == owner:
+                del self.games[key]
+
+    def keys(self):
+        with self.lock:
+            return [key for key, game in self.games.items()
+                    if game[3] is not None]
+
+
+def open_store(url):
+    """the store for a STATE_STORE setting: memory or sqlite:///<path>"""
+    if url == 'memory':
+        return MemoryStore()
+    if url.startswith('sqlite:///'):
+        return SQLiteStore(url[len('sqlite:///'):])
+    raise ValueError(f'unknown state store {url!r}')
+
+
+class StoreJournal():
+    """keeps a game in a StateStore, in place of a mafia_journal.Journal
+
+    Every journaled Game call saves the whole game. If another worker
+    saved it first, the game gets reloaded and the call fails with
+    StaleStateError.
+    """
+
+    def __init__(self, store, key, owner):
+        self.store = store
+        self.key = key
+        self.owner = owner
+        self.version = 0
+
+    def attach(self, game):
+        """load what's stored (if anything) into game and keep it stored"""
+        self.store.claim(self.key, self.owner)
+        # what a failed first save rolls back to
+        self.blank = game.snapshot()
+        self.refresh(game)
+        game.journal = self
+        return game
+
+    def refresh(self, game):
+        """catch up with saves of other workers, True if there were any"""
+        version, snapshot = self.store.load(self.key)
+        if version == self.version:
+            return False
+        game.restore(snapshot if snapshot is not None else self.blank)
+        self.version = version
+        logger.debug('Loaded %s at version %d.', self.key, version)
+        return True
+
+    def record(self, game, event, args):
+        try:
+            self.version = self.store.save(self.key, self.owner,
+                                           game.snapshot(), self.version)
+        except StoreError:
+            # the store didn't take the change, so undo it: back to what
+            # the store has, somebody else's save or our last one
+            self.version = None
+            try:
+                self.refresh(game)
+            except StoreError:
+                # still can't read it, the next refresh() rolls back
+                logger.warning('Could not reload %s.', self.key)
+            raise
+
+    def sync(self):
+        # every record is saved already
+        pass
+
+    def close(self, remove=False):
+        try:
+            if remove:
+                self.store.delete(self.key, self.owner)
+            else:
+                self.store.release(self.key, self.owner)
+        except NotOwnerError:
+            # the lease runs out on its own
+            logger.warning('Could not let go of %s.', self.key)
@@ -1,10 +1,10 @@
-import os
+import atexit
+from functools import partial
+import queue
 import logging
+import logging.handlers
 # import logging_tree
 # import datetime
-import gettext
-
-from dotenv import load_dotenv
 
 import discord
 from discord.ext import commands
@@ -13,64 +13,69 @@ from discord.ext import commands
 import mafia
 
 # import the mafiabot utils module
-from mafiabot_utils import MafiaBot, ErrorContext, Channel, Permissions
-
-load_dotenv()
-LANG_THEME = os.getenv('LANG_THEME')
-lang = LANG_THEME
-lang_translations = gettext.translation('base',
-                                        localedir='locales',
-                                        languages=[lang])
-lang_translations.install()
+import mafiabot_utils
+from mafiabot_utils import (GameRegistry, ErrorContext, Channel,
+                            Permissions, gather_limited,
+                            VoiceMoveScheduler, VOICE_MOVE_CONCURRENCY)
+from mafiabot_config import Config
+
+# all settings, read once
+config = Config.from_env()
+mafiabot_utils.configure(config)
+lang_translations = config.translation('base')
 def _(x): return lang_translations.gettext(x)
 # def _(x): return x
 
 
 # set up logging
-# first, our own logs
+# records only get queued here, a background thread writes them out
+# so logging never blocks the event loop
+LOG_LEVEL = config.log_level.upper()
+log_queue = queue.SimpleQueue()
+handler = logging.handlers.QueueHandler(log_queue)
+log_listener = logging.handlers.QueueListener(log_queue,
+                                              logging.StreamHandler())
+log_listener.start()
+atexit.register(log_listener.stop)
+# every module's logger (mafia, mafiabot_utils, mafia_store, ...) hands
+# its records up to the root logger, so they all go through the queue
+root_logger = logging.getLogger()
+root_logger.setLevel(LOG_LEVEL)  # logging level
+root_logger.addHandler(handler)
 logger = logging.getLogger(__name__)  # get logger for this module
-logger.setLevel(logging.DEBUG)  # logging level
-handler = logging.StreamHandler()
-logger.addHandler(handler)
-# get mafia.py logger
-mafialogger = logging.getLogger('mafia')
-mafialogger.setLevel(logging.DEBUG)
-mafialogger.addHandler(handler)
-# get mafiabot_utils.py logger
-utilslogger = logging.getLogger('mafiabot_utils')
-utilslogger.setLevel(logging.DEBUG)
-utilslogger.addHandler(handler)
-# finally discord.py logs
+# discord.py only when something's wrong
 discord_logger = logging.getLogger('discord')
 discord_logger.setLevel(logging.WARNING)
-discord_logger.addHandler(handler)
 
 # logging_tree to help with logging config
 # logging_tree.printout()
 
-# set up discord basics
-
-TOKEN = os.getenv('DISCORD_TOKEN')
-GUILD = os.getenv('DISCORD_GUILD')
-OPEN_CHANNEL = int(os.getenv('DISCORD_OPEN_CHANNEL'))
-MAFIA_CHANNEL = int(os.getenv('DISCORD_MAFIA_CHANNEL'))
-COP_CHANNEL = int(os.getenv('DISCORD_COP_CHANNEL'))
-OPEN_VOICE_CHANNEL = int(os.getenv('DISCORD_OPEN_VOICE_CHANNEL'))
-MAFIA_VOICE_CHANNEL = int(os.getenv('DISCORD_MAFIA_VOICE_CHANNEL'))
-COP_VOICE_CHANNEL = int(os.getenv('DISCORD_COP_VOICE_CHANNEL'))
-ALIVE_ROLE = int(os.getenv('DISCORD_ALIVE_ROLE'))
-DEAD_ROLE = int(os.getenv('DISCORD_DEAD_ROLE'))
-DISCORD_CATEGORY = int(os.getenv('DISCORD_CATEGORY'))
-WAITING_TIME_DAY_IN_SEC = int(os.getenv('WAIT_DAY_SEC'))
-WAITING_TIME_NIGHT_IN_SEC = int(os.getenv('WAIT_NIGHT_SEC'))
-WARNING_TIMER_IN_SEC = int(os.getenv('WARNING_TIMER_SEC'))
-
 BOTNAME = _('mafiabot')
 
-USEFAKEUSERBOTS = False
+# a channel edit replaces all overwrites in one call, so single member
+# edits only pay off if at most this many overwrites changed
+PERMISSION_DIFF_LIMIT = 1
+
+# member edits share one rate limit bucket per guild, so don't fire
+# all of them at once
+ROLE_SYNC_CONCURRENCY = 5
+
+# guilds that can't be set up at the same time on_ready
+GUILD_SETUP_CONCURRENCY = 5
+
+
+class MafiaClient(commands.AutoShardedBot):
+    async def close(self):
+        try:
+            # nobody would ever use the pooled beds again
+            await registry.close()
+        finally:
+            await super().close()
+
 
-# init the bot
-bot = commands.Bot(command_prefix='!')
+# init the bot, discord tells it how many shards (gateway connections)
+# it needs for all its guilds
+bot = MafiaClient(command_prefix='!')
 
 
 # logging function for bot commands
@@ -79,8 +84,23 @@ def cmdlog(ctx):
                 _('invoked by ') + ctx.author.name)
 
 
+def get_game(ctx=None, guild=None):
+    """the MafiaBot (and through it the game) belonging to a guild"""
+    if ctx and not guild:
+        return registry.get(ctx.guild, registry.lobby(ctx.guild, ctx.channel))
+    return registry.get(guild)
+
+
+def find_game(ctx):
+    """like get_game, but None instead of a new game if there's none"""
+    return registry.find(ctx.guild, registry.lobby(ctx.guild, ctx.channel))
+
+
 def game_running(ctx):
-    return myGame.status != mafia.GameStatus.NOT_RUNNING
+    myMafiaBot = registry.find(ctx.guild)
+    if myMafiaBot is None:
+        return False
+    return myMafiaBot.game.status != mafia.GameStatus.NOT_RUNNING
 
 
 @bot.check
@@ -92,46 +112,103 @@ async def globally_block_dms(ctx):
 @bot.check
 async def accepted_channels(ctx):
     # only accept if sent from within one of our channels
-    channels = myMafiaBot.get_channels(ctx.guild).values()
-    logger.debug(str(channels))
-    logger.debug(str(ctx.channel))
-    return (ctx.channel in channels)
+    return ctx.channel.id in registry.accepted_channels(ctx.guild)
 
 
 @bot.event
 async def on_ready():
     await bot.change_presence(activity=discord.Game(name=_('Mafia')))
     logger.info(f'{bot.user.name} ' + _('has connected to Discord!'))
-    guild = discord.utils.get(bot.guilds, name=GUILD)
+    # games have to be sorted into the right shards before recovering
+    registry.reshard(bot.shard_count or 1)
+    # the names of our channels and roles, to find them in other guilds
+    registry.layout.learn(bot.guilds)
+    registry.recover(bot.shard_ids)
+    # every guild with our channels (just DISCORD_GUILD if that's set),
+    # unless another worker sharing the state store runs its game
+    guilds = [guild for guild in bot.guilds
+              if registry.accepted_channels(guild) and
+              (config.guild is None or guild.name == config.guild) and
+              registry.owns(guild)]
+    await gather_limited([set_up_guild(guild) for guild in guilds],
+                         GUILD_SETUP_CONCURRENCY)
+
+
+async def set_up_guild(guild):
     logger.info(f'{bot.user.name} ' +
                 _('is connected to the following guild:') + '\n'
-                f'    {guild.name}(id: {guild.id})')
+                f'    {guild.name}(id: {guild.id}, shard {guild.shard_id})')
+    myMafiaBot = registry.find(guild)
+    # only start from a clean slate if there was no game going on
+    clean = (myMafiaBot is None or
+             myMafiaBot.game.status == mafia.GameStatus.NOT_RUNNING)
+    myMafiaBot = get_game(guild=guild)
     await guild.get_member(bot.user.id).edit(
         nick=BOTNAME + " [" +
-        print_bot_nick(myGame.status)
+        print_bot_nick(myMafiaBot.game.status)
         + "]")
-    if USEFAKEUSERBOTS:
-        logger.warning('WLL CREATE FAKE USER BOTS FOR USE IN'
-                       'HIDDEN CHANNELS')
-        await myMafiaBot.createfakeuserbots()
-    await reset_channel_permissions(None, guild=guild)
+    if clean:
+        await reset_channel_permissions(None, guild=guild)
+    else:
+        await myMafiaBot.resume(guild, cycle)
+    await myMafiaBot.sweep_beds(guild)
     # await guild.get_role(ALIVE_ROLE).edit(name=_('Warten auf Spielbeginn'))
 
 
+@bot.event
+async def on_shard_ready(shard_id):
+    logger.info('Shard %d is ready.', shard_id)
+
+
 @bot.event
 async def on_message(message):
+    if message.guild is None:
+        return
+    # how busy each shard is
+    registry.shard(message.guild).events += 1
+    # most messages aren't for us, drop them before parsing anything
+    if message.channel.id not in registry.accepted_channels(message.guild):
+        return
     if message.author == bot.user:
         return
+    # another worker serves this guild's game
+    if not registry.owns(message.guild):
+        return
+    myMafiaBot = registry.find(message.guild)
+    if myMafiaBot is not None:
+        # we might have just taken it over from a worker that died
+        await myMafiaBot.resume(message.guild, cycle)
     # important, without this bot commands wont work!
     await bot.process_commands(message)
 
 
+@bot.event
+async def on_guild_channel_create(channel):
+    # beds come and go all the time, only our own channels matter
+    if registry.layout.concerns(channel):
+        registry.channels_changed(channel.guild)
+
+
+@bot.event
+async def on_guild_channel_delete(channel):
+    if registry.layout.concerns(channel):
+        registry.channels_changed(channel.guild)
+
+
 @bot.command(name=_('join'), help=_('Join a game.'))
 async def join(ctx):
     cmdlog(ctx)
+    await get_game(ctx).actor.run(join_game, ctx)
+
+
+async def join_game(ctx):
+    myMafiaBot = get_game(ctx)
+    myGame = myMafiaBot.game
     try:
         name = ctx.author.nick if ctx.author.nick else ctx.author.name
-        player = myGame.join(ctx.author.id, name)
+        # so they can be voted for by either name
+        aliases = [ctx.author.name] if ctx.author.nick else []
+        player = myGame.join(ctx.author.id, name, *aliases)
     except mafia.Error as err:
         logger.exception(_('Failed to join'))
         err.context = ErrorContext.JOIN_ATTEMPT
@@ -141,6 +218,8 @@ async def join(ctx):
         logger.warning(msg)
         await ctx.send(msg)
     else:
+        # so their bed is ready once night falls
+        myMafiaBot.warm_bed(ctx.guild, ctx.author)
         await assign_discord_role(ctx, player)
         msg = name + " " + _('joined the game.')
         logger.info(msg)
@@ -157,10 +236,10 @@ async def rules(ctx):
         of""")
 
     msg += " "
-    msg += str(WAITING_TIME_DAY_IN_SEC/60)
+    msg += str(config.wait_day_sec/60)
     msg += _(""" minutes, if there is no result by then, your action goes to waste.
         Nighttime lasts """)
-    msg += str(WAITING_TIME_NIGHT_IN_SEC/60)
+    msg += str(config.wait_night_sec/60)
     msg += _(""" minutes.``````In the member list
         on the right, you can see who\'s alive and who\'s dead. If this
         doesn\'t update, use !status to print the current status in the chat.
@@ -173,6 +252,12 @@ async def rules(ctx):
 @bot.command(name=_('start'), help=_('Start the game.'))
 async def start(ctx):
     cmdlog(ctx)
+    await get_game(ctx).actor.run(start_game, ctx)
+
+
+async def start_game(ctx):
+    myMafiaBot = get_game(ctx)
+    myGame = myMafiaBot.game
     try:
         if len(myGame.players) < 2:
             raise mafia.Error
@@ -191,10 +276,10 @@ async def start(ctx):
         of""")
 
         msg += " "
-        msg += str(WAITING_TIME_DAY_IN_SEC/60)
+        msg += str(config.wait_day_sec/60)
         msg += _(""" minutes, if there is no result by then, your action goes to waste.
         Nighttime lasts """)
-        msg += str(WAITING_TIME_NIGHT_IN_SEC/60)
+        msg += str(config.wait_night_sec/60)
         msg += _(""" minutes.``````In the member list
         on the right, you can see who\'s alive and who\'s dead. If this
         doesn\'t update, use !status to print the current status in the chat.
@@ -228,6 +313,15 @@ async def start(ctx):
 @commands.is_owner()
 async def stop(ctx):
     cmdlog(ctx)
+    await get_game(ctx).actor.run(stop_game, ctx)
+
+
+async def stop_game(ctx):
+    myMafiaBot = find_game(ctx)
+    if myMafiaBot is None:
+        # stopped already, e.g. by the end of the game
+        return
+    myGame = myMafiaBot.game
     try:
         await reset_channel_permissions(ctx)
         await remove_all_discord_roles(ctx)
@@ -241,7 +335,7 @@ async def stop(ctx):
     else:
         msg = _('Game stopped!')
         logger.info(msg)
-        myMafiaBot.timer.cancel()
+        myMafiaBot.timer_stop()
         # bot.get_cog('MyTimer').cancel_timer()
         await change_bot_name(ctx)
         await ctx.send(msg)
@@ -250,6 +344,8 @@ async def stop(ctx):
         await send_status_update(ctx,
                                  game_status=True,
                                  player_status=False)
+        # the game is over, free it up for the next one
+        registry.evict(ctx.guild)
 
 
 @bot.command(name=_('next'), help=_('Go to the next game phase.'))
@@ -257,10 +353,17 @@ async def stop(ctx):
 @commands.is_owner()
 async def next(ctx):
     cmdlog(ctx)
-    await cycle(ctx)
+    await get_game(ctx).actor.run(cycle, ctx)
 
 
-async def cycle(ctx, restart_timer=True, check_mafia=False):
+async def cycle(ctx, restart_timer=True, check_mafia=False,
+                myMafiaBot=None):
+    current = find_game(ctx)
+    if current is None or myMafiaBot not in (None, current):
+        # the game got stopped since, don't start a new one
+        return
+    myMafiaBot = current
+    myGame = myMafiaBot.game
     try:
         if check_mafia:
             logger.debug('mafiacheck')
@@ -277,7 +380,8 @@ async def cycle(ctx, restart_timer=True, check_mafia=False):
                         con
                     )
                     logger.debug(con)
-                    await finished_vote_compute(ctx, "", mafia_return)
+                    await finished_vote_compute(ctx, myMafiaBot, "",
+                                                mafia_return)
         myGame.cycle()
     except mafia.Error as err:
         logger.exception(_('Failed to cycle.'))
@@ -295,7 +399,8 @@ async def cycle(ctx, restart_timer=True, check_mafia=False):
                                  ['open_channel'])
 
 
-async def finished_vote_compute(ctx, msg, vote_return_object, update=True):
+async def finished_vote_compute(ctx, myMafiaBot, msg, vote_return_object,
+                                update=True):
     logger.debug('in finish_vote')
     # everbody voted, votes got executed
     switcher = {
@@ -336,19 +441,71 @@ async def finished_vote_compute(ctx, msg, vote_return_object, update=True):
 @bot.command(name=_('status'))
 @commands.check(game_running)
 async def status(ctx):
+    myMafiaBot = get_game(ctx)
     # msg = myMafiaBot.print_game_status() + "\n"
     msg = myMafiaBot.print_players() + "\n"
     await ctx.send(msg)
 
+@bot.command(name=_('shards'), help=_('Show how busy the shards are.'))
+@commands.is_owner()
+async def shards(ctx):
+    cmdlog(ctx)
+    latencies = dict(bot.latencies)
+    lines = []
+    for stats in registry.stats(reset=True):
+        latency = latencies.get(stats['shard'])
+        lines.append(
+            _('Shard') + f" {stats['shard']}: {stats['games']} " +
+            _('games') + f" ({stats['running']} " + _('running') + "), " +
+            f"{stats['events_per_sec']:.1f} " + _('messages/s') +
+            (f", {latency * 1000:.0f} ms" if latency is not None else ""))
+        logger.info('Shard %d: %d games, %d running, %.1f messages/s.',
+                    stats['shard'], stats['games'], stats['running'],
+                    stats['events_per_sec'])
+    await ctx.send("\n".join(lines) or _('No shards yet.'))
+
+
+@bot.command(name=_('history'), help=_('Show who won the past games.'))
+async def history(ctx):
+    cmdlog(ctx)
+    if registry.archive is None:
+        await ctx.send(_('No game history is kept.'))
+        return
+    # could be lots of games, don't hold up everything else
+    rates = await bot.loop.run_in_executor(None, registry.archive.win_rates)
+    lines = [_('Games by number of players:')]
+    for players, (games, villager, mafioso) in rates.items():
+        lines.append(
+            f"    {players} " + _('players') + f": {games} " + _('games') +
+            ", " + _('villagers won') + f" {villager / games:.0%}, " +
+            _('mafia won') + f" {mafioso / games:.0%}")
+    await ctx.send("\n".join(lines) if rates else _('No games yet.'))
+
+
 @bot.command(name=_('vote'), help=_('Vote for a user.'))
 @commands.check(game_running)
-async def vote(ctx, member: discord.Member):
+async def vote(ctx, *, target):
     cmdlog(ctx)
-    try:
-        vote_return_object = myGame.vote_user(ctx.author.id, member.id)
-    except mafia.Error as err:
-        logger.exception(_('Failed to vote.'))
-        msg = myMafiaBot.error_message(err)
+    myMafiaBot = get_game(ctx)
+    myGame = myMafiaBot.game
+
+    def apply():
+        try:
+            # no need for the member cache, the game knows who's playing
+            return myGame.vote_user(ctx.author.id,
+                                    myMafiaBot.find_target(target))
+        except mafia.Error as err:
+            logger.exception(_('Failed to vote.'))
+            return err
+
+    # votes arriving together get applied together, see GameActor
+    await myMafiaBot.actor.post(
+        apply, partial(publish_vote, ctx, myMafiaBot), batch=True)
+
+
+async def publish_vote(ctx, myMafiaBot, vote_return_object):
+    if isinstance(vote_return_object, mafia.Error):
+        msg = myMafiaBot.error_message(vote_return_object)
         logger.warning(msg)
         await ctx.send(msg)
     else:
@@ -360,11 +517,11 @@ async def vote(ctx, member: discord.Member):
             parallel = False
             if vote_return_object.parallel_vote is not None:
                 logger.debug('parallel vote!')
-                await finished_vote_compute(ctx, msg,
+                await finished_vote_compute(ctx, myMafiaBot, msg,
                                             vote_return_object.parallel_vote,
                                             update=True)
                 parallel = True
-            await finished_vote_compute(ctx, msg,
+            await finished_vote_compute(ctx, myMafiaBot, msg,
                                         vote_return_object, not parallel)
         elif vote_return_object.voteresult == mafia.VoteResult.UNDERWAY:
             # send to same channel as the last vote
@@ -383,36 +540,33 @@ def print_bot_nick(status):
 
 
 async def change_bot_name(ctx):
+    myMafiaBot = find_game(ctx)
+    status = (mafia.GameStatus.NOT_RUNNING if myMafiaBot is None
+              else myMafiaBot.game.status)
     # only if we changed to the following statuses
-    if myGame.status in [mafia.GameStatus.DAY_TALK,
-                         mafia.GameStatus.NIGHT_TALK,
-                         mafia.GameStatus.NOT_RUNNING]:
+    if status in [mafia.GameStatus.DAY_TALK,
+                  mafia.GameStatus.NIGHT_TALK,
+                  mafia.GameStatus.NOT_RUNNING]:
         await ctx.guild.get_member(bot.user.id).edit(
             nick=BOTNAME + " [" +
-            print_bot_nick(myGame.status)
+            print_bot_nick(status)
             + "]")
 
 
-def game_over():
-    alive_mafia = []
-    alive_villagers = []
-    for p in myGame.players:
-        if not p.is_dead():
-            if p.role == mafia.Role.MAFIA:
-                alive_mafia.append(p)
-            else:
-                alive_villagers.append(p)
-    if not alive_mafia:
-        return mafia.Role.VILLAGER
-    if not alive_villagers:
-        return mafia.Role.MAFIA
-    return False
+def game_over(myGame):
+    # the game keeps count of who's alive
+    return myGame.game_over()
 
 
 async def normal_game_update(ctx, show_status=False,
                              show_channel_list=False,
                              restart_timer=True):
-    game_result = game_over()
+    myMafiaBot = find_game(ctx)
+    if myMafiaBot is None:
+        # the game is over already
+        return
+    myGame = myMafiaBot.game
+    game_result = game_over(myGame)
     if game_result:
         msg = _('Game over!')
         if game_result == mafia.Role.VILLAGER:
@@ -422,8 +576,8 @@ async def normal_game_update(ctx, show_status=False,
         msg += myMafiaBot.print_players(True)
         await myMafiaBot.get_channels(ctx.guild)['open_channel'].send(
             msg)
-        myMafiaBot.timer.cancel()
-        await stop(ctx)
+        myMafiaBot.timer_stop()
+        await stop_game(ctx)
         return
     # check if we need to reassign roles because of a 'location change'
     if myGame.status in [mafia.GameStatus.DAY_TALK,
@@ -452,13 +606,15 @@ async def normal_game_update(ctx, show_status=False,
                                      player_roles=False,
                                      channel=myMafiaBot.get_channels(ctx.guild)
                                      ['open_channel'])
-        logger.debug(f'restart timer in normalgame:{restart_timer}')
+        logger.debug('restart timer in normalgame:%s', restart_timer)
         if restart_timer:
             await myMafiaBot.timer_start(ctx, cycle)
             # await bot.get_cog('MyTimer').start_timer(ctx, skip_next=True)
 
 
 async def send_channel_notifs(ctx):
+    myMafiaBot = get_game(ctx)
+    myGame = myMafiaBot.game
     channels = myMafiaBot.get_channels(ctx.guild)
     # open_channel = channels['open_channel']
     mafia_channel = channels['mafia_channel']
@@ -475,32 +631,48 @@ async def send_channel_notifs(ctx):
 
 
 async def assign_all_discord_roles(ctx):
-    for p in myGame.players:
-        # alive or something else goes in the same role
-        await assign_discord_role(ctx, p)
+    # alive or something else goes in the same role
+    await sync_discord_roles(ctx.guild, get_game(ctx).game.players)
 
 
 async def remove_all_discord_roles(ctx=None, guild=None):
     if ctx and not guild:
         guild = ctx.guild
-    for p in myGame.players:
-        await guild.get_member(p.ID).remove_roles(
-            guild.get_role(ALIVE_ROLE),
-            guild.get_role(DEAD_ROLE))
+    await sync_discord_roles(guild, get_game(guild=guild).game.players,
+                             remove=True)
 
 
 async def assign_discord_role(ctx, player):
-    p = player
-    if p.status != mafia.PlayerStatus.DEAD:
-        await ctx.guild.get_member(p.ID).add_roles(
-                ctx.guild.get_role(ALIVE_ROLE))
-        await ctx.guild.get_member(p.ID).remove_roles(
-            ctx.guild.get_role(DEAD_ROLE))
-    if p.status == mafia.PlayerStatus.DEAD:
-        await ctx.guild.get_member(p.ID).add_roles(
-                ctx.guild.get_role(DEAD_ROLE))
-        await ctx.guild.get_member(p.ID).remove_roles(
-            ctx.guild.get_role(ALIVE_ROLE))
+    await sync_discord_roles(ctx.guild, [player])
+
+
+async def sync_discord_roles(guild, players, remove=False):
+    """give players the alive or dead role (or neither, if remove)
+
+    Every member that needs a change gets exactly one edit, the edits
+    run concurrently but at most ROLE_SYNC_CONCURRENCY at a time.
+    """
+    layout = registry.layout.resolve(guild)
+    alive_role, dead_role = layout['alive_role'], layout['dead_role']
+    edits = []
+    for p in players:
+        member = guild.get_member(p.ID)
+        if member is None:
+            continue
+        if remove:
+            wanted = set()
+        elif p.status == mafia.PlayerStatus.DEAD:
+            wanted = {dead_role}
+        else:
+            wanted = {alive_role}
+        # the first role is @everyone, which we can't assign
+        current = set(member.roles[1:])
+        # a guild without the roles just doesn't get them
+        roles = ((current - {alive_role, dead_role}) | wanted) - {None}
+        if roles != current:
+            edits.append(member.edit(roles=list(roles)))
+    await gather_limited(edits, ROLE_SYNC_CONCURRENCY)
+    logger.debug('Synced discord roles of %d members.', len(edits))
 
 
 async def set_channel_permits(guild, channel, permits=None,
@@ -513,9 +685,9 @@ async def set_channel_permits(guild, channel, permits=None,
                 read_messages=False,
                 send_messages=False)
         if permits is not None:
-            for p in permits[Permissions.ALLOW_VIEW]:
-                allow_write = (p in permits[Permissions.ALLOW_WRITE])
-                overwrites[guild.get_member(p.ID)] = (
+            for ID in permits[Permissions.ALLOW_VIEW]:
+                allow_write = (ID in permits[Permissions.ALLOW_WRITE])
+                overwrites[guild.get_member(ID)] = (
                     discord.PermissionOverwrite(
                         read_messages=True,
                         send_messages=allow_write))
@@ -527,25 +699,41 @@ async def set_channel_permits(guild, channel, permits=None,
                 connect=False,
                 speak=False)
         if permits is not None:
-            for p in permits[Permissions.ALLOW_VIEW]:
-                allow_speak = (p in permits[Permissions.ALLOW_WRITE])
-                logger.debug(f'{p.name} allowed to speak in {channel.name}?:'
-                             f'{allow_speak}')
-                overwrites[guild.get_member(p.ID)] = (
+            for ID in permits[Permissions.ALLOW_VIEW]:
+                allow_speak = (ID in permits[Permissions.ALLOW_WRITE])
+                logger.debug('%s allowed to speak in %s?:%s',
+                             ID, channel.name, allow_speak)
+                overwrites[guild.get_member(ID)] = (
                     discord.PermissionOverwrite(
                         view_channel=True,
                         read_messages=True,
                         connect=True,
                         speak=allow_speak))
-    await channel.edit(overwrites=overwrites)
-    logger.debug(f'Set channel permits (voice={voice}) '
-                 f'for {channel.name} (id:{channel.id})')
+    myMafiaBot = get_game(guild=guild)
+    diff = myMafiaBot.overwrites_diff(channel, overwrites)
+    if diff is None or len(diff) > PERMISSION_DIFF_LIMIT:
+        await channel.edit(overwrites=overwrites)
+    elif diff:
+        for target, overwrite in diff.items():
+            await channel.set_permissions(target, overwrite=overwrite)
+    else:
+        logger.debug('Channel permits unchanged for %s (id:%s), skipped',
+                     channel.name, channel.id)
+        return
+    myMafiaBot.overwrites_applied(channel, overwrites)
+    logger.debug('Set channel permits (voice=%s) for %s (id:%s)',
+                 voice, channel.name, channel.id)
 
 
 async def move_users_to_voice_channels(guild, channel_permits):
+    myMafiaBot = get_game(guild=guild)
+    myGame = myMafiaBot.game
     open_channel = myMafiaBot.get_channels(guild)['open_voice_channel']
     mafia_channel = myMafiaBot.get_channels(guild)['mafia_voice_channel']
     cop_channel = myMafiaBot.get_channels(guild)['cop_voice_channel']
+    # plan all the moves first, then do them at once
+    # so everybody goes dark at about the same time
+    moves = VoiceMoveScheduler()
 
     if myGame.status in [mafia.GameStatus.NOT_RUNNING,
                          mafia.GameStatus.DAY_TALK,
@@ -558,45 +746,52 @@ async def move_users_to_voice_channels(guild, channel_permits):
 
         await move_players_back_to_open(guild,
                                         channel_permits[Channel.OPEN]
-                                        [Permissions.ALLOW_VIEW])
-        pass
+                                        [Permissions.ALLOW_VIEW],
+                                        moves)
     elif myGame.status in [mafia.GameStatus.NIGHT_TALK,
                            mafia.GameStatus.NIGHT_VOTE]:
         if open_channel:
             # kick every person that doesn't have another channel
-            can_move_to_channels = []
+            can_move_to_channels = set()
             if mafia_channel:
-                can_move_to_channels += channel_permits[
-                    Channel.MAFIA][Permissions.ALLOW_VIEW]
+                can_move_to_channels.update(
+                    channel_permits[Channel.MAFIA][Permissions.ALLOW_VIEW])
             if cop_channel:
-                can_move_to_channels += channel_permits[
-                    Channel.COP][Permissions.ALLOW_VIEW]
+                can_move_to_channels.update(
+                    channel_permits[Channel.COP][Permissions.ALLOW_VIEW])
+            to_bed = []
             for m in open_channel.members:
-                if mafia.Player(m.id) not in can_move_to_channels:
+                if m.id not in can_move_to_channels:
                     # definitely kick nonplaying people
-                    if mafia.Player(m.id) not in myGame.players:
-                        await m.move_to(None)
+                    if not myGame.has_player(m.id):
+                        moves.plan(m, None)
                         continue
-                    # maybe too slow?
-                    await myMafiaBot.move_to_their_own_channel(guild, m)
+                    to_bed.append(m)
                     # maybe just everyone instead
-                    # await m.move_to(None)
+                    # moves.plan(m, None)
+            beds = await gather_limited(
+                [myMafiaBot.get_their_own_channel(guild, m) for m in to_bed],
+                VOICE_MOVE_CONCURRENCY)
+            for m, bed in zip(to_bed, beds):
+                moves.plan(m, bed)
 
         if mafia_channel:
-            for p in channel_permits[Channel.MAFIA][Permissions.ALLOW_VIEW]:
-                m = guild.get_member(p.ID)
+            for ID in channel_permits[Channel.MAFIA][Permissions.ALLOW_VIEW]:
+                m = guild.get_member(ID)
                 if m.voice is not None:
                     # we can only move if user is already connected
-                    await m.move_to(mafia_channel)
+                    moves.plan(m, mafia_channel)
         if cop_channel:
-            for p in channel_permits[Channel.COP][Permissions.ALLOW_VIEW]:
-                m = guild.get_member(p.ID)
+            for ID in channel_permits[Channel.COP][Permissions.ALLOW_VIEW]:
+                m = guild.get_member(ID)
                 if m.voice is not None:
                     # we can only move if user is already connected
-                    await m.move_to(cop_channel)
+                    moves.plan(m, cop_channel)
+    myMafiaBot.last_move_latency = await moves.run()
 
 
 async def OLDmove_to_their_own_channel(guild, member):
+    myMafiaBot = get_game(guild=guild)
     overwrites = {
         guild.default_role: discord.PermissionOverwrite(read_messages=False),
         member: discord.PermissionOverwrite(read_messages=True,
@@ -610,20 +805,29 @@ async def OLDmove_to_their_own_channel(guild, member):
     await member.move_to(secret_channel)
 
 
-async def move_players_back_to_open(guild, permits):
+async def move_players_back_to_open(guild, permits, moves=None):
+    myMafiaBot = get_game(guild=guild)
+    # run the moves ourselves if nobody else plans to
+    run_moves = moves is None
+    if run_moves:
+        moves = VoiceMoveScheduler()
     if myMafiaBot.get_channels(guild)['open_voice_channel']:
-        for p in permits:
-            m = guild.get_member(p.ID)
+        for ID in permits:
+            m = guild.get_member(ID)
             if m.voice is not None:
                 # we can only move if user is already connected
-                await guild.get_member(p.ID).move_to(
-                    myMafiaBot.get_channels(guild)['open_voice_channel'])
+                moves.plan(
+                    m, myMafiaBot.get_channels(guild)['open_voice_channel'])
+    if run_moves:
+        myMafiaBot.last_move_latency = await moves.run()
     # for ch in myNewChannels:
     #    await ch.delete()
     #    myNewChannels.remove(ch)
 
 
 async def assign_channels(ctx):
+    myMafiaBot = get_game(ctx)
+    myGame = myMafiaBot.game
     channel_permits = myMafiaBot.get_assigned_channels()
     guild = ctx.guild
     channels = myMafiaBot.get_channels(guild)
@@ -665,7 +869,7 @@ async def assign_channels(ctx):
 async def reset_channel_permissions(ctx=None, guild=None):
     if ctx and not guild:
         guild = ctx.guild
-    channels = myMafiaBot.get_channels(guild)
+    channels = get_game(guild=guild).get_channels(guild)
 
     if channels['open_channel']:
         await sync_channel_permissions(channels['open_channel'])
@@ -683,6 +887,8 @@ async def reset_channel_permissions(ctx=None, guild=None):
 
 
 async def hide_channel_for_default(channel):
+    # we don't track these overwrites, next time send them all
+    get_game(guild=channel.guild).overwrites_applied(channel)
     # read_messages also works for voice channels
     await channel.set_permissions(channel.guild.default_role,
                                   read_messages=False,
@@ -690,6 +896,7 @@ async def hide_channel_for_default(channel):
 
 
 async def sync_channel_permissions(channel):
+    get_game(guild=channel.guild).overwrites_applied(channel)
     await channel.edit(sync_permissions=True)
 
 
@@ -705,22 +912,26 @@ async def send_status_update(ctx,
                              player_status=False,
                              player_roles=False,
                              channel=None):
-    status = ""
-    if game_status:
-        status += myMafiaBot.print_game_status() + "\n"
-    if player_status:
-        status += myMafiaBot.print_players(player_roles) + "\n"
+    myMafiaBot = find_game(ctx)
+    if myMafiaBot is None:
+        return
+    status = myMafiaBot.print_status(game_status, player_status,
+                                     player_roles)
     if channel is not None:
         await channel.send(status)
     else:
         await ctx.send(status)
     logger.info(_('Sent status update.'))
 
-# start new mafia game
+# one mafia game per guild, created on demand
 myNewChannels = []
-myGame = mafia.Game()
-myMafiaBot = MafiaBot(myGame)
+registry = GameRegistry(config)
 # bot.add_cog(MyTimer(bot))
-# run the bot
-logger.info(_('Connecting to Discord...'))
-bot.run(TOKEN)
+if __name__ == '__main__':
+    # run the bot (importing it, e.g. for a replay, doesn't)
+    logger.info(_('Connecting to Discord...'))
+    try:
+        bot.run(config.token)
+    finally:
+        # let other workers take over our games right away
+        registry.release()
@@ -0,0 +1,139 @@
+"""Settings of the bot, read from the environment (and .env) once.
+
+mafiabot.py loads a Config at startup and hands it to everything that
+needs it, see the README for the variables.
+"""
+import os
+import gettext
+import functools
+from dataclasses import MISSING, dataclass, fields
+from typing import Optional
+
+
+class ConfigError(ValueError):
+    """Raised when a setting is missing or makes no sense"""
+
+
+@dataclass(frozen=True)
+class Config:
+    token: str
+    open_channel: int
+    mafia_channel: int
+    cop_channel: int
+    open_voice_channel: int
+    mafia_voice_channel: int
+    cop_voice_channel: int
+    alive_role: int
+    dead_role: int
+    category: int
+    wait_day_sec: int
+    wait_night_sec: int
+    warning_timer_sec: int
+    lang_theme: str
+    # if set, only this guild (by name) gets a game
+    guild: Optional[str] = None
+    log_level: str = 'DEBUG'
+    # how many unused 'Your bed' channels to keep around between games
+    bed_pool_size: int = 10
+    # where to journal the games so they survive a restart
+    journal_dir: Optional[str] = None
+    # memory or sqlite:///<path>, shared by all workers serving the games
+    state_store: Optional[str] = None
+    # how this worker shows up as owner of games in the state store
+    worker_id: Optional[str] = None
+    # where to archive finished games, see mafia_history.py
+    history_dir: Optional[str] = None
+
+    # field -> environment variable
+    ENV = {
+        'token': 'DISCORD_TOKEN',
+        'guild': 'DISCORD_GUILD',
+        'open_channel': 'DISCORD_OPEN_CHANNEL',
+        'mafia_channel': 'DISCORD_MAFIA_CHANNEL',
+        'cop_channel': 'DISCORD_COP_CHANNEL',
+        'open_voice_channel': 'DISCORD_OPEN_VOICE_CHANNEL',
+        'mafia_voice_channel': 'DISCORD_MAFIA_VOICE_CHANNEL',
+        'cop_voice_channel': 'DISCORD_COP_VOICE_CHANNEL',
+        'alive_role': 'DISCORD_ALIVE_ROLE',
+        'dead_role': 'DISCORD_DEAD_ROLE',
+        'category': 'DISCORD_CATEGORY',
+        'wait_day_sec': 'WAIT_DAY_SEC',
+        'wait_night_sec': 'WAIT_NIGHT_SEC',
+        'warning_timer_sec': 'WARNING_TIMER_SEC',
+        'lang_theme': 'LANG_THEME',
+        'log_level': 'LOG_LEVEL',
+        'bed_pool_size': 'BED_POOL_SIZE',
+        'journal_dir': 'JOURNAL_DIR',
+        'state_store': 'STATE_STORE',
+        'worker_id': 'WORKER_ID',
+        'history_dir': 'HISTORY_DIR',
+    }
+
+    @classmethod
+    def from_env(cls, environ=None, dotenv=True):
+        """read the settings from environ (os.environ and .env by default)"""
+        if environ is None:
+            if dotenv:
+                from dotenv import load_dotenv
+                load_dotenv()
+            environ = os.environ
+        values, problems = {}, []
+        for field in fields(cls):
+            name = Config.ENV[field.name]
+            value = environ.get(name)
+            if value is None or value == '':
+                if field.default is MISSING:
+                    problems.append(f'{name} is missing')
+                continue
+            if field.type is int:
+                try:
+                    value = int(value)
+                except ValueError:
+                    problems.append(f'{name} should be a number, '
+                                    f'not {value!r}')
+                    continue
+            values[field.name] = value
+        if problems:
+            raise ConfigError('; '.join(problems))
+        config = cls(**values)
+        config.validate()
+        return config
+
+    def validate(self):
+        problems = []
+        if self.warning_timer_sec < 0:
+            problems.append('WARNING_TIMER_SEC can\'t be negative')
+        for name in ('wait_day_sec', 'wait_night_sec'):
+            if getattr(self, name) < self.warning_timer_sec:
+                problems.append(f'{Config.ENV[name]} has to be at least '
+                                f'WARNING_TIMER_SEC')
+        if self.bed_pool_size < 0:
+            problems.append('BED_POOL_SIZE can\'t be negative')
+        if self.state_store is not None and not (
+                self.state_store == 'memory' or
+                self.state_store.startswith('sqlite:///')):
+            problems.append('STATE_STORE has to be memory or '
+                            'sqlite:///<path>')
+        if self.state_store == 'memory' and self.worker_id is not None:
+            # every worker would have a store of its own
+            problems.append('STATE_STORE=memory can\'t be shared by '
+                            'workers, use sqlite:///<path>')
+        if problems:
+            raise ConfigError('; '.join(problems))
+
+    @property
+    def game_channels(self):
+        """the channels the bot listens to"""
+        return (self.open_channel, self.open_voice_channel,
+                self.mafia_channel, self.mafia_voice_channel,
+                self.cop_channel, self.cop_voice_channel, self.category)
+
+    def translation(self, domain):
+        return translation(domain, self.lang_theme)
+
+
+@functools.lru_cache(maxsize=None)
+def translation(domain, lang):
+    """the gettext catalog of a domain, loaded only once"""
+    return gettext.translation(domain, localedir='locales',
+                               languages=[lang])
@@ -0,0 +1,454 @@
+"""In-process stand-in for a Discord guild, to replay games offline.
+
+The fakes implement just the parts of discord.py mafiabot.py and
+mafiabot_utils.py use: a guild with roles, members, text and voice
+channels. Every call that would hit the Discord API goes through a
+FakeAPI, which records it and can simulate latency and 429 responses.
+
+    python mafiabot_fake.py --players 8 --latency 0.05 --rate-limit 0.02
+
+replays a full game through the bot's command handlers and prints the
+API calls and wall time of every phase change.
+"""
+import os
+import time
+import random
+import asyncio
+import argparse
+from collections import Counter, namedtuple
+from types import SimpleNamespace
+
+# channel/role ids of the fake guild, see fake_env()
+FAKE_IDS = {
+    'DISCORD_OPEN_CHANNEL': 101,
+    'DISCORD_MAFIA_CHANNEL': 102,
+    'DISCORD_COP_CHANNEL': 103,
+    'DISCORD_OPEN_VOICE_CHANNEL': 104,
+    'DISCORD_MAFIA_VOICE_CHANNEL': 105,
+    'DISCORD_COP_VOICE_CHANNEL': 106,
+    'DISCORD_ALIVE_ROLE': 201,
+    'DISCORD_DEAD_ROLE': 202,
+    'DISCORD_CATEGORY': 100,
+}
+FAKE_GUILD_ID = 1
+FAKE_BOT_ID = 2
+
+Call = namedtuple('Call', ['route', 'target', 'status', 'started',
+                           'duration'])
+
+
+class FakeAPI():
+    """records every simulated REST call
+
+    latency is the time every call takes (in seconds), rate_limit is
+    the chance that a call gets a 429 first. Like discord.py, we then
+    wait retry_after and try again, so callers only see it as latency.
+    """
+
+    def __init__(self, latency=0.0, rate_limit=0.0, retry_after=0.5,
+                 seed=None):
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.calls = []
+
+    async def call(self, route, target):
+        started = time.perf_counter()
+        while self.rng.random() < self.rate_limit:
+            await asyncio.sleep(self.retry_after)
+            self.calls.append(Call(route, target, 429, started,
+                                   time.perf_counter() - started))
+            started = time.perf_counter()
+        await asyncio.sleep(self.latency)
+        self.calls.append(Call(route, target, 200, started,
+                               time.perf_counter() - started))
+
+    def routes(self, since=0):
+        return Counter(call.route for call in self.calls[since:])
+
+    def rate_limited(self, since=0):
+        return sum(1 for call in self.calls[since:] if call.status == 429)
+
+
+class FakeObject():
+    def __init__(self, guild, id, name):
+        self.guild = guild
+        self.id = id
+        self.name = name
+
+    def __eq__(self, other):
+        return isinstance(other, self.__class__) and other.id == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __str__(self):
+        return self.name
+
+    @property
+    def mention(self):
+        return f'<#{self.id}>'
+
+
+class FakeRole(FakeObject):
+    pass
+
+
+class FakeMember(FakeObject):
+    def __init__(self, guild, id, name, nick=None):
+        super().__init__(guild, id, name)
+        self.nick = nick
+        self.bot = False
+        self.roles = [guild.default_role]
+        self.voice = None
+
+    @property
+    def mention(self):
+        return f'<@{self.id}>'
+
+    async def edit(self, roles=None, nick=None):
+        await self.guild.api.call('edit_member', self)
+        if roles is not None:
+            self.roles = [self.guild.default_role] + list(roles)
+        if nick is not None:
+            self.nick = nick
+
+    async def add_roles(self, *roles):
+        await self.guild.api.call('add_role', self)
+        for role in roles:
+            if role not in self.roles:
+                self.roles.append(role)
+
+    async def remove_roles(self, *roles):
+        await self.guild.api.call('remove_role', self)
+        self.roles = [r for r in self.roles if r not in roles]
+
+    async def move_to(self, channel):
+        await self.guild.api.call('move_member', self)
+        if self.voice is not None:
+            self.voice.channel.members.remove(self)
+        if channel is None:
+            self.voice = None
+        else:
+            channel.members.append(self)
+            self.voice = SimpleNamespace(channel=channel)
+
+
+class FakeTyping():
+    def __init__(self, channel):
+        self.channel = channel
+
+    async def __aenter__(self):
+        await self.channel.guild.api.call('typing', self.channel)
+
+    async def __aexit__(self, *exc):
+        pass
+
+
+class FakeChannel(FakeObject):
+    def __init__(self, guild, id, name, voice=False, category=None):
+        super().__init__(guild, id, name)
+        self.voice = voice
+        self.category = category
+        # what str(discord's channel.type) would be
+        self.type = 'voice' if voice else 'text'
+        self.overwrites = {}
+        # in voice channels, who is connected
+        self.members = []
+        self.messages = []
+
+    async def send(self, content):
+        await self.guild.api.call('send_message', self)
+        self.messages.append(content)
+
+    async def edit(self, overwrites=None, sync_permissions=False):
+        await self.guild.api.call('edit_channel', self)
+        if overwrites is not None:
+            self.overwrites = dict(overwrites)
+        if sync_permissions:
+            self.overwrites = {}
+
+    async def set_permissions(self, target, overwrite=None, **permissions):
+        await self.guild.api.call('set_permissions', self)
+        if overwrite is None and not permissions:
+            self.overwrites.pop(target, None)
+        else:
+            self.overwrites[target] = overwrite or permissions
+
+    async def delete(self):
+        await self.guild.api.call('delete_channel', self)
+        self.guild.channel_map.pop(self.id, None)
+
+    def typing(self):
+        return FakeTyping(self)
+
+
+class FakeState():
+    """the part of discord.py's connection state a commands.Context uses"""
+    allowed_mentions = None
+
+    def __init__(self, guild):
+        self.guild = guild
+        # ctx.send ends up in http.send_message
+        self.http = self
+
+    async def send_message(self, channel_id, content, **options):
+        await self.guild.get_channel(channel_id).send(content)
+        return {}
+
+    def create_message(self, channel, data):
+        return None
+
+
+class FakeMessage():
+    """a message as the bot's on_message gets it"""
+
+    def __init__(self, author, channel, content):
+        self.id = channel.guild.new_id()
+        self.author = author
+        self.channel = channel
+        self.guild = channel.guild
+        self.content = content
+        self._state = channel.guild.state
+
+
+class FakeGuild():
+    """a guild with the game's channels and roles
+
+    They get the ids of ids (FAKE_IDS by default, what the config
+    says), other ids make a guild the bot only knows by the names.
+    """
+
+    def __init__(self, api=None, id=FAKE_GUILD_ID, name='mafia', ids=None):
+        ids = ids if ids is not None else FAKE_IDS
+        self.api = api if api is not None else FakeAPI()
+        self.state = FakeState(self)
+        self.id = id
+        self.name = name
+        self.shard_id = 0
+        self.default_role = FakeRole(self, id, '@everyone')
+        # id -> channel and role, discord.py has lists of them
+        self.channel_map = {}
+        self.role_map = {}
+        self.members = {}
+        self.next_id = 1000
+        category = self.add_channel(ids['DISCORD_CATEGORY'], 'mafia')
+        category.type = 'category'
+        for key, name, voice in [
+                ('DISCORD_OPEN_CHANNEL', 'village', False),
+                ('DISCORD_MAFIA_CHANNEL', 'mafia', False),
+                ('DISCORD_COP_CHANNEL', 'cops', False),
+                ('DISCORD_OPEN_VOICE_CHANNEL', 'village', True),
+                ('DISCORD_MAFIA_VOICE_CHANNEL', 'mafia', True),
+                ('DISCORD_COP_VOICE_CHANNEL', 'cops', True)]:
+            self.add_channel(ids[key], name, voice, category)
+        for key, name in [('DISCORD_ALIVE_ROLE', 'alive'),
+                          ('DISCORD_DEAD_ROLE', 'dead')]:
+            self.role_map[ids[key]] = FakeRole(self, ids[key], name)
+        self.me = self.add_member('mafiabot', id=FAKE_BOT_ID)
+        self.me.bot = True
+
+    def new_id(self):
+        self.next_id += 1
+        return self.next_id
+
+    @property
+    def channels(self):
+        return list(self.channel_map.values())
+
+    @property
+    def roles(self):
+        return list(self.role_map.values())
+
+    def add_channel(self, id, name, voice=False, category=None):
+        self.channel_map[id] = FakeChannel(self, id, name, voice, category)
+        return self.channel_map[id]
+
+    def add_member(self, name, id=None, nick=None, voice_channel=None):
+        member = FakeMember(self, id or self.new_id(), name, nick)
+        self.members[member.id] = member
+        if voice_channel is not None:
+            voice_channel.members.append(member)
+            member.voice = SimpleNamespace(channel=voice_channel)
+        return member
+
+    def get_channel(self, id):
+        return self.channel_map.get(id)
+
+    def get_member(self, id):
+        return self.members.get(id)
+
+    def get_role(self, id):
+        return self.role_map.get(id)
+
+    async def create_voice_channel(self, name, category=None,
+                                   overwrites=None):
+        await self.api.call('create_channel', self)
+        channel = self.add_channel(self.new_id(), name, True, category)
+        channel.overwrites = dict(overwrites or {})
+        return channel
+
+
+class FakeContext():
+    """what the command handlers get instead of a commands.Context"""
+
+    def __init__(self, guild, author, channel, command=None):
+        self.guild = guild
+        self.author = author
+        self.channel = channel
+        self.command = SimpleNamespace(name=command)
+
+    async def send(self, content):
+        await self.channel.send(content)
+
+
+def fake_env():
+    """point the bot config at the fake guild (before importing it)"""
+    for key, value in FAKE_IDS.items():
+        os.environ[key] = str(value)
+    os.environ['DISCORD_GUILD'] = 'mafia'
+    os.environ.setdefault('DISCORD_TOKEN', 'fake')
+    os.environ.setdefault('WAIT_DAY_SEC', '360')
+    os.environ.setdefault('WAIT_NIGHT_SEC', '120')
+    os.environ.setdefault('WARNING_TIMER_SEC', '30')
+    os.environ.setdefault('LANG_THEME', 'de-wolf')
+    os.environ.setdefault('LOG_LEVEL', 'CRITICAL')
+
+
+def import_bot(guild):
+    """import mafiabot configured for (and logged in to) the fake guild"""
+    fake_env()
+    import mafiabot
+    # the bot only ever needs its own id
+    mafiabot.bot._connection.user = guild.me
+    return mafiabot
+
+
+class PhaseStat(namedtuple('PhaseStat', ['command', 'before', 'after',
+                                         'calls', 'rate_limited',
+                                         'seconds', 'routes'])):
+    pass
+
+
+async def run_command(guild, stats, command, ctx, *args, **kwargs):
+    """run a bot command and record the API calls it caused"""
+    mafiabot = import_bot(guild)
+    ctx.command.name = command.name
+    game = mafiabot.registry.find(guild)
+    before = game.game.status if game else None
+    since = len(guild.api.calls)
+    started = time.perf_counter()
+    await command(ctx, *args, **kwargs)
+    seconds = time.perf_counter() - started
+    game = mafiabot.registry.find(guild)
+    after = game.game.status if game else None
+    stats.append(PhaseStat(command.name, before, after,
+                           len(guild.api.calls) - since,
+                           guild.api.rate_limited(since),
+                           seconds, guild.api.routes(since)))
+
+
+def choose_target(game, voter, rng):
+    targets = [p for p in game.players
+               if not p.is_dead() and p.ID != voter.ID]
+    return rng.choice(targets)
+
+
+async def replay_game(players=8, api=None, seed=None, in_voice=1.0,
+                      max_phases=100):
+    """play one game with random votes through the command handlers"""
+    import mafia
+    guild = FakeGuild(api)
+    mafiabot = import_bot(guild)
+    rng = random.Random(seed)
+    random.seed(seed)
+    channels = mafiabot.get_game(guild=guild).get_channels(guild)
+    open_voice = channels['open_voice_channel']
+    members = [guild.add_member(f'player{i}',
+                                voice_channel=open_voice
+                                if rng.random() < in_voice else None)
+               for i in range(players)]
+    stats = []
+    await mafiabot.reset_channel_permissions(None, guild=guild)
+
+    def context(member, channel):
+        return FakeContext(guild, member, channel)
+
+    for member in members:
+        await run_command(guild, stats, mafiabot.join,
+                          context(member, channels['open_channel']))
+    await run_command(guild, stats, mafiabot.start,
+                      context(members[0], channels['open_channel']))
+    for _ in range(max_phases):
+        myMafiaBot = mafiabot.registry.find(guild)
+        if myMafiaBot is None or not mafiabot.game_running(
+                context(members[0], channels['open_channel'])):
+            break
+        game = myMafiaBot.game
+        status = game.status
+        for p in list(game.players):
+            if game.status != status or mafiabot.registry.find(guild) is None:
+                break
+            if p.is_dead() or p.last_vote is not None:
+                continue
+            if status == mafia.GameStatus.DAY_VOTE:
+                channel = channels['open_channel']
+            elif p.role == mafia.Role.MAFIA:
+                channel = channels['mafia_channel']
+            elif p.role == mafia.Role.COP:
+                channel = channels['cop_channel']
+            else:
+                continue
+            target = guild.get_member(choose_target(game, p, rng).ID)
+            await run_command(guild, stats, mafiabot.vote,
+                              context(guild.get_member(p.ID), channel),
+                              target=target.mention)
+        if (mafiabot.registry.find(guild) is not None and
+                game.status == status):
+            # nobody could agree, time runs out
+            await run_command(guild, stats, mafiabot.next,
+                              context(members[0], channels['open_channel']))
+    myMafiaBot = mafiabot.registry.find(guild)
+    if myMafiaBot is not None:
+        myMafiaBot.timer_stop()
+    return guild, stats
+
+
+def print_stats(guild, stats, seconds):
+    api = guild.api
+    print(f'{len(api.calls)} API calls ({api.rate_limited()} rate limited) '
+          f'in {seconds:.2f}s')
+    for route, count in api.routes().most_common():
+        print(f'    {route:>16}: {count}')
+    print('phase changes:')
+    for stat in stats:
+        if stat.before == stat.after:
+            continue
+        print(f'    {stat.command:>6} {stat.before} -> {stat.after}: '
+              f'{stat.calls} calls ({stat.rate_limited} rate limited) '
+              f'in {stat.seconds:.3f}s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--players', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds every API call takes')
+    parser.add_argument('--rate-limit', type=float, default=0.0,
+                        help='chance of a 429 per API call')
+    parser.add_argument('--retry-after', type=float, default=0.5)
+    parser.add_argument('--in-voice', type=float, default=1.0,
+                        help='share of players connected to voice')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+    api = FakeAPI(args.latency, args.rate_limit, args.retry_after,
+                  args.seed)
+    started = time.perf_counter()
+    guild, stats = asyncio.run(replay_game(args.players, api, args.seed,
+                                           args.in_voice))
+    print_stats(guild, stats, time.perf_counter() - started)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+"""Synthetic players to load-test the bot offline, in a mafiabot_fake guild.
+
+Every SyntheticPlayer is a member of a FakeGuild whose messages go
+through the bot's on_message, just like a human's would arrive from
+Discord: commands get parsed, checked and run by discord.py, chatter
+gets dropped. They join, chat wherever their permissions let them write
+and vote following one of the STRATEGIES, all at the same time, so the
+bot sees what a busy lobby throws at it. The first player hosts: they
+start the game, and as the bot's owner, cut phases short with !next when
+the others can't agree (like the phase timer would).
+
+    python mafiabot_players.py --players 100 --strategy bandwagon --chat 0.3
+
+plays a game with 100 of them and prints how the bot coped.
+"""
+import time
+import random
+import asyncio
+import argparse
+from collections import Counter
+
+import mafia
+from mafia_bench import STRATEGIES as BENCH_STRATEGIES, voters
+from mafiabot_fake import FakeAPI, FakeGuild, FakeMessage, import_bot
+
+# rounds of voting before the host calls !next
+MAX_VOTE_ROUNDS = 3
+# and phases (per player) before giving up on a game
+MAX_PHASES_PER_PLAYER = 4
+
+CHATTER = (
+    'I trust {name}.',
+    'Where were you last night, {name}?',
+    '{name} is way too quiet.',
+    'Could be anybody, really.',
+    'I\'m just a simple villager.',
+)
+
+
+def bandwagon_target(game, voter, rng):
+    """whoever got the most votes of the voter's side so far"""
+    night = game.status == mafia.GameStatus.NIGHT_VOTE
+    votes = Counter(p.last_vote for p in game.players
+                    if p.last_vote is not None and not p.is_dead() and
+                    (not night or p.role == voter.role))
+    for index, _votes in votes.most_common():
+        target = game.players[index]
+        if not target.is_dead() and target is not voter:
+            return target
+    return BENCH_STRATEGIES['random'](game, voter, rng)
+
+
+STRATEGIES = dict(BENCH_STRATEGIES, bandwagon=bandwagon_target)
+
+
+class SyntheticPlayer():
+    def __init__(self, lobby, member, strategy, rng):
+        self.lobby = lobby
+        self.member = member
+        self.strategy = strategy
+        self.rng = rng
+
+    async def send(self, channel, content):
+        self.lobby.sent[content.startswith('!')] += 1
+        await self.lobby.mafiabot.on_message(
+            FakeMessage(self.member, channel, content))
+
+    def can_write(self, channel):
+        overwrite = channel.overwrites.get(self.member)
+        return bool(getattr(overwrite, 'send_messages', False))
+
+    async def act(self, game, can_vote):
+        """maybe chat, and vote if it's our turn"""
+        lobby = self.lobby
+        # nobody types at exactly the same time
+        await asyncio.sleep(self.rng.random() * lobby.think)
+        if not game.has_player(self.member.id):
+            # not playing, or the game is over already
+            return
+        player = game.get_player(self.member.id)
+        if self.rng.random() < lobby.chat:
+            channels = [channel for channel in lobby.text_channels
+                        if self.can_write(channel)]
+            if channels:
+                name = self.rng.choice(game.players).name
+                await self.send(self.rng.choice(channels),
+                                self.rng.choice(CHATTER).format(name=name))
+        if self.member.id not in can_vote:
+            return
+        if game.status == mafia.GameStatus.DAY_VOTE:
+            channel = lobby.channels['open_channel']
+        elif player.role == mafia.Role.MAFIA:
+            channel = lobby.channels['mafia_channel']
+        else:
+            channel = lobby.channels['cop_channel']
+        target = self.strategy(game, player, self.rng)
+        await self.send(channel, lobby.command('vote') + ' ' +
+                        lobby.guild.get_member(target.ID).mention)
+
+
+class SyntheticLobby():
+    """a fake guild full of SyntheticPlayers"""
+
+    def __init__(self, players=8, strategy='random', chat=0.1, think=0.05,
+                 api=None, seed=None, in_voice=1.0):
+        self.guild = FakeGuild(api)
+        self.mafiabot = import_bot(self.guild)
+        self.rng = random.Random(seed)
+        random.seed(seed)
+        self.chat = chat
+        # seconds a player takes at most to act
+        self.think = think
+        self.channels = self.mafiabot.get_game(
+            guild=self.guild).get_channels(self.guild)
+        self.text_channels = [self.channels[name] for name in (
+            'open_channel', 'mafia_channel', 'cop_channel')]
+        open_voice = self.channels['open_voice_channel']
+        self.players = [
+            SyntheticPlayer(self, self.guild.add_member(
+                f'player{i}', voice_channel=open_voice
+                if self.rng.random() < in_voice else None),
+                STRATEGIES[strategy], random.Random(self.rng.random()))
+            for i in range(players)]
+        self.host = self.players[0]
+        # messages sent, by whether they were commands
+        self.sent = Counter()
+        self.errors = Counter()
+
+    def command(self, callback):
+        """what to type for a command, their names get translated"""
+        return '!' + getattr(self.mafiabot, callback).name
+
+    def game(self):
+        myMafiaBot = self.mafiabot.registry.find(self.guild)
+        if (myMafiaBot is None or
+                myMafiaBot.game.status == mafia.GameStatus.NOT_RUNNING):
+            return None
+        return myMafiaBot.game
+
+    async def on_command_error(self, ctx, error):
+        self.errors[type(error).__name__] += 1
+
+    async def play(self, max_phases=None):
+        """one game, returns a report dict"""
+        if max_phases is None:
+            max_phases = MAX_PHASES_PER_PLAYER * len(self.players)
+        bot = self.mafiabot.bot
+        # what the bot schedules has to run on this loop
+        bot.loop = asyncio.get_running_loop()
+        # the host runs the game, like the bot's owner would
+        bot.owner_id = self.host.member.id
+        bot.add_listener(self.on_command_error)
+        await self.mafiabot.reset_channel_permissions(None, guild=self.guild)
+        open_channel = self.channels['open_channel']
+        started = time.perf_counter()
+        calls = len(self.guild.api.calls)
+        await asyncio.gather(*(player.send(open_channel,
+                                           self.command('join'))
+                               for player in self.players))
+        await self.host.send(open_channel, self.command('start'))
+        myMafiaBot = self.mafiabot.registry.find(self.guild)
+        phases = 0
+        while self.game() is not None and phases < max_phases:
+            game = self.game()
+            status = game.status
+            for _round in range(MAX_VOTE_ROUNDS):
+                can_vote = {p.ID for p in voters(game)}
+                await asyncio.gather(*(player.act(game, can_vote)
+                                       for player in self.players))
+                if self.game() is not game or game.status != status:
+                    break
+            else:
+                await self.host.send(open_channel, self.command('next'))
+            phases += 1
+        bot.remove_listener(self.on_command_error)
+        finished = self.game() is None
+        if not finished:
+            myMafiaBot.timer_stop()
+        return {
+            'players': len(self.players),
+            'phases': phases,
+            'finished': finished,
+            'seconds': time.perf_counter() - started,
+            'commands': self.sent[True],
+            'chatter': self.sent[False],
+            'replies': sum(len(channel.messages)
+                           for channel in self.guild.channels),
+            'errors': dict(self.errors),
+            'api_calls': len(self.guild.api.calls) - calls,
+            'actor': myMafiaBot.actor.stats() if myMafiaBot else {},
+        }
+
+
+def print_report(report):
+    print(f"{report['players']} players, {report['phases']} phases "
+          f"in {report['seconds']:.2f}s" +
+          ("" if report['finished'] else " (gave up)"))
+    print(f"    {report['commands']} commands, {report['chatter']} chat "
+          f"messages, {report['replies']} replies, "
+          f"{report['api_calls']} API calls")
+    actor = report['actor']
+    if actor:
+        print(f"    {actor['actions']} game actions in {actor['batches']} "
+              f"batches (up to {actor['max_batch']} at once)")
+    for error, count in sorted(report['errors'].items()):
+        print(f'    {error}: {count}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--players', type=int, default=8)
+    parser.add_argument('--strategy', choices=STRATEGIES, default='random')
+    parser.add_argument('--chat', type=float, default=0.1,
+                        help='chance a player chats, per round')
+    parser.add_argument('--think', type=float, default=0.05,
+                        help='seconds a player takes at most to act')
+    parser.add_argument('--max-phases', type=int, default=None,
+                        help='give up after this many phases '
+                        f'(default {MAX_PHASES_PER_PLAYER} per player)')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds every API call takes')
+    parser.add_argument('--in-voice', type=float, default=1.0,
+                        help='share of players connected to voice')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+    lobby = SyntheticLobby(args.players, args.strategy, args.chat,
+                           args.think, FakeAPI(args.latency, seed=args.seed),
+                           args.seed, args.in_voice)
+    print_report(asyncio.run(lobby.play(args.max_phases)))
+
+
+if __name__ == '__main__':
+    main()
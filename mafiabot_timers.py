@@ -0,0 +1,179 @@
+"""One hierarchical timer wheel for the phase timers of all games.
+
+Instead of a sleeping asyncio task per game (and per warning), games
+schedule their deadlines on a shared TimerWheel. Scheduling and
+cancelling are O(1), a single driver task advances the wheel tick by
+tick and keeps track of how late timers fire.
+"""
+import math
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+TICK_SEC = 0.1
+SLOTS = 64
+LEVELS = 4  # 64**4 ticks of 0.1s, about 19 days
+# complain if timers fire this late, the event loop is too busy
+DRIFT_WARNING_SEC = 1.0
+
+
+class Timer():
+    __slots__ = ('expires', 'callback', 'args', 'slot', 'wheel')
+
+    def __init__(self, wheel, expires, callback, args):
+        self.wheel = wheel
+        self.expires = expires  # in ticks
+        self.callback = callback
+        self.args = args
+        self.slot = None
+
+    def cancel(self):
+        """safe to call again, or after the timer fired"""
+        if self.slot is not None:
+            self.slot.discard(self)
+            self.slot = None
+            self.wheel.pending -= 1
+            self.wheel.cancelled += 1
+
+
+class TimerWheel():
+    def __init__(self, tick=TICK_SEC, slots=SLOTS, levels=LEVELS):
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self.wheel = [[set() for _ in range(slots)] for _ in range(levels)]
+        self.current = 0  # ticks since self.started
+        self.started = None
+        self.driver = None
+        self.wakeup = None
+        # coroutine callbacks still running, asyncio only keeps weak
+        # references to tasks
+        self.running = set()
+        # metrics
+        self.pending = 0
+        self.scheduled = 0
+        self.fired = 0
+        self.cancelled = 0
+        self.max_drift = 0.0
+        self.total_drift = 0.0
+
+    def schedule(self, delay, callback, *args):
+        """call callback(*args) in delay seconds, coroutines get awaited"""
+        loop = asyncio.get_event_loop()
+        if self.started is None:
+            self.started = loop.time()
+        now = (loop.time() - self.started) / self.tick
+        if not self.pending:
+            # the wheel is empty, so it can skip the ticks it sat idle
+            self.current = max(self.current, math.floor(now))
+        # never in the current tick, that one might be done already
+        expires = max(math.ceil(now + delay / self.tick), self.current + 1)
+        timer = Timer(self, expires, callback, args)
+        self.place(timer)
+        self.pending += 1
+        self.scheduled += 1
+        if self.driver is None or self.driver.done():
+            self.wakeup = asyncio.Event()
+            self.driver = loop.create_task(self.drive())
+        elif self.pending == 1:
+            self.wakeup.set()
+        return timer
+
+    def place(self, timer):
+        delta = timer.expires - self.current
+        level = 0
+        while level < self.levels - 1 and delta >= self.slots ** (level + 1):
+            level += 1
+        # too far out for the wheel: park it, it gets placed again
+        # every time its slot cascades
+        expires = min(timer.expires, self.current +
+                      self.slots ** self.levels - 1)
+        slot = self.wheel[level][(expires // self.slots ** level)
+                                 % self.slots]
+        slot.add(timer)
+        timer.slot = slot
+
+    def advance(self):
+        """move one tick forward and fire what expired"""
+        self.current += 1
+        level = 0
+        # when a level wraps, the next level's slot comes down
+        while (level < self.levels - 1 and
+               self.current % self.slots ** (level + 1) == 0):
+            level += 1
+            self.cascade(level)
+        slot = self.wheel[0][self.current % self.slots]
+        if slot:
+            timers = list(slot)
+            slot.clear()
+            for timer in timers:
+                timer.slot = None
+                if timer.expires > self.current:
+                    # parked, not yet
+                    self.place(timer)
+                else:
+                    self.fire(timer)
+
+    def cascade(self, level):
+        slot = self.wheel[level][(self.current // self.slots ** level)
+                                 % self.slots]
+        timers = list(slot)
+        slot.clear()
+        for timer in timers:
+            self.place(timer)
+
+    def fire(self, timer):
+        self.pending -= 1
+        self.fired += 1
+        try:
+            result = timer.callback(*timer.args)
+            if asyncio.iscoroutine(result):
+                task = asyncio.get_event_loop().create_task(result)
+                self.running.add(task)
+                task.add_done_callback(self.callback_done)
+        except Exception:
+            logger.exception('Timer callback failed.')
+
+    def callback_done(self, task):
+        self.running.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error('Timer callback failed.',
+                         exc_info=task.exception())
+
+    async def drive(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            if not self.pending:
+                # nothing to do, sleep until somebody schedules something
+                self.wakeup.clear()
+                await self.wakeup.wait()
+            due = self.started + (self.current + 1) * self.tick
+            await asyncio.sleep(max(due - loop.time(), 0))
+            # catch up if we're late
+            now_tick = math.floor((loop.time() - self.started) / self.tick)
+            while self.current < now_tick:
+                due = self.started + (self.current + 1) * self.tick
+                fired = self.fired
+                self.advance()
+                if self.fired != fired:
+                    drift = loop.time() - due
+                    self.max_drift = max(self.max_drift, drift)
+                    self.total_drift += drift * (self.fired - fired)
+                    if drift > DRIFT_WARNING_SEC:
+                        logger.warning('Timers fired %.2fs late.', drift)
+
+    def stop(self):
+        if self.driver is not None:
+            self.driver.cancel()
+            self.driver = None
+
+    def stats(self):
+        return {
+            'pending': self.pending,
+            'scheduled': self.scheduled,
+            'fired': self.fired,
+            'cancelled': self.cancelled,
+            'max_drift': self.max_drift,
+            'mean_drift': self.total_drift / self.fired if self.fired else 0,
+        }
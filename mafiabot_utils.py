@@ -1,43 +1,42 @@
 import mafia
+from mafia_journal import Journal
+from mafia_history import GameRecorder, HistoryArchive
+from mafia_store import (LEASE_SEC, NotOwnerError, StaleStateError,
+                         StoreJournal, open_store)
+from mafiabot_timers import TimerWheel
 
 import os
+import re
+import time
+import socket
 import logging
 import asyncio
-from dotenv import load_dotenv
 from enum import Enum
-import discord
 import gettext
+# discord gets imported where it's needed, it takes a while to load
+# and the game logic and tools can do without
 
 logger = logging.getLogger(__name__)
 
-# set up discord basics
-load_dotenv()
-TOKEN = os.getenv('DISCORD_TOKEN')
-GUILD = os.getenv('DISCORD_GUILD')
-OPEN_CHANNEL = int(os.getenv('DISCORD_OPEN_CHANNEL'))
-MAFIA_CHANNEL = int(os.getenv('DISCORD_MAFIA_CHANNEL'))
-COP_CHANNEL = int(os.getenv('DISCORD_COP_CHANNEL'))
-OPEN_VOICE_CHANNEL = int(os.getenv('DISCORD_OPEN_VOICE_CHANNEL'))
-MAFIA_VOICE_CHANNEL = int(os.getenv('DISCORD_MAFIA_VOICE_CHANNEL'))
-COP_VOICE_CHANNEL = int(os.getenv('DISCORD_COP_VOICE_CHANNEL'))
-ALIVE_ROLE = int(os.getenv('DISCORD_ALIVE_ROLE'))
-DEAD_ROLE = int(os.getenv('DISCORD_DEAD_ROLE'))
-DISCORD_CATEGORY = int(os.getenv('DISCORD_CATEGORY'))
-WAITING_TIME_DAY_IN_SEC = int(os.getenv('WAIT_DAY_SEC'))
-WAITING_TIME_NIGHT_IN_SEC = int(os.getenv('WAIT_NIGHT_SEC'))
-WARNING_TIMER_IN_SEC = int(os.getenv('WARNING_TIMER_SEC'))
-
-
-load_dotenv()
-LANG_THEME = os.getenv('LANG_THEME')
-lang = LANG_THEME
-lang_translations = gettext.translation('utils',
-                                        localedir='locales',
-                                        languages=[lang])
-lang_translations.install()
-def _(x): return lang_translations.gettext(x)
-# prepare for gettext
-# def _(x):   return x
+# messages stay untranslated until configure() picks a language
+translations = gettext.NullTranslations()
+def _(x): return translations.gettext(x)
+
+
+def configure(config):
+    """translate messages to config's language"""
+    global translations
+    translations = config.translation('utils')
+
+
+# moving members uses the same rate limit bucket (per guild) as
+# editing them, so keep the number of moves in flight small
+VOICE_MOVE_CONCURRENCY = 5
+VOICE_MOVE_RETRIES = 2
+VOICE_MOVE_BACKOFF_SEC = 0.5
+
+# <@id> or <@!id>, what a ping looks like in a message
+MENTION = re.compile(r'<@!?([0-9]+)>$')
 
 
 class ErrorContext(Enum):
@@ -59,30 +58,773 @@ class Permissions(Enum):
     BLOCK = 2
 
 
-class MafiaBot():
+async def gather_limited(coros, limit):
+    """await coroutines concurrently, but at most limit at a time"""
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(coro):
+        async with semaphore:
+            return await coro
+
+    return await asyncio.gather(*(run(c) for c in coros))
+
+
+class VoiceMoveScheduler():
+    """collects the voice moves of a phase change and runs them together"""
+
+    def __init__(self, concurrency=VOICE_MOVE_CONCURRENCY,
+                 retries=VOICE_MOVE_RETRIES):
+        self.concurrency = concurrency
+        self.retries = retries
+        self.moves = {}  # member -> voice channel (None disconnects)
+        self.latencies = []
+
+    def plan(self, member, channel):
+        # if a member gets planned twice, the last plan wins
+        self.moves[member] = channel
+
+    async def run(self):
+        """do all planned moves, returns how long it took in seconds"""
+        started = time.perf_counter()
+        self.latencies = []
+        await gather_limited([self.move(m, ch, started)
+                              for m, ch in self.moves.items()],
+                             self.concurrency)
+        total = time.perf_counter() - started
+        if self.moves:
+            logger.info('Moved %d members in %.2fs (slowest %.2fs)',
+                        len(self.moves), total,
+                        max(self.latencies, default=total))
+        self.moves = {}
+        return total
+
+    async def move(self, member, channel, started):
+        import discord
+        for attempt in range(self.retries + 1):
+            try:
+                await member.move_to(channel)
+            except discord.HTTPException as err:
+                # client errors won't go away by trying again
+                # (except for rate limits)
+                retry = err.status == 429 or err.status >= 500
+                if not retry or attempt == self.retries:
+                    logger.warning('Could not move %s to %s: %s',
+                                   member, channel, err)
+                    return False
+                await asyncio.sleep(VOICE_MOVE_BACKOFF_SEC * 2 ** attempt)
+            else:
+                self.latencies.append(time.perf_counter() - started)
+                return True
+
+
+def bed_overwrites(guild, member=None):
+    """a voice channel only member (if any) can see, but not speak in"""
+    import discord
+    overwrites = {
+        guild.default_role: discord.PermissionOverwrite(
+            read_messages=False)
+    }
+    if member is not None:
+        overwrites[member] = discord.PermissionOverwrite(
+            read_messages=True, speak=False)
+    return overwrites
+
+
+def bed_done(task):
+    """log what went wrong making a bed, nobody might be waiting for it"""
+    if not task.cancelled() and task.exception() is not None:
+        logger.error('Could not make a bed.', exc_info=task.exception())
+
+
+class BedPool():
+    """unused 'Your bed' voice channels of a guild, kept warm across games"""
+
+    def __init__(self, size=10):
+        self.size = size
+        self.free = []
+
+    async def acquire(self, guild, category, member):
+        """a bed for member, from the pool if there is one"""
+        import discord
+        while self.free:
+            channel = self.free.pop()
+            try:
+                await channel.edit(overwrites=bed_overwrites(guild, member))
+            except discord.NotFound:
+                # somebody deleted it in the meantime
+                continue
+            return channel
+        return await guild.create_voice_channel(
+            _('Your bed'),
+            category=category,
+            overwrites=bed_overwrites(guild, member))
+
+    async def release(self, guild, channels):
+        """take beds back, hide them and delete what doesn't fit"""
+        keep = channels[:max(self.size - len(self.free), 0)]
+        drop = channels[len(keep):]
+        await gather_limited(
+            [ch.edit(overwrites=bed_overwrites(guild)) for ch in keep] +
+            [ch.delete() for ch in drop],
+            VOICE_MOVE_CONCURRENCY)
+        self.free.extend(keep)
+        logger.debug('Released %d beds, %d free.',
+                     len(channels), len(self.free))
+
+    async def clear(self):
+        """delete every free bed"""
+        free, self.free = self.free, []
+        await gather_limited([ch.delete() for ch in free],
+                             VOICE_MOVE_CONCURRENCY)
+
+
+class GameActor():
+    """Runs everything that changes a game strictly one after the other.
+
+    Commands, votes and timeouts get queued in the game's mailbox and a
+    single worker works through it, so a phase change can't interleave
+    with a vote or a timeout. Votes that pile up while the worker is
+    busy get applied in one go, then their results get published.
+    """
+
+    def __init__(self, before=None):
+        self.mailbox = asyncio.Queue()
+        # called before every action (or batch), e.g. to reload the game
+        self.before = before
+        self.worker = None
+        self.held = None  # taken from the mailbox, but not part of a batch
+        self.closed = False
+        # metrics
+        self.actions = 0
+        self.batches = 0
+        self.max_batch = 0
+
+    def inside(self):
+        return (self.worker is not None and
+                asyncio.current_task() is self.worker)
+
+    def post(self, apply, publish=None, batch=False):
+        """queue apply, then publish(its result), returns a future for that
+
+        apply is a coroutine function, or a plain function if batch is
+        set, so it can run right after other queued batch actions.
+        """
+        future = asyncio.get_event_loop().create_future()
+        self.mailbox.put_nowait((apply, publish, batch, future))
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.get_event_loop().create_task(self.work())
+        return future
+
+    async def run(self, action, *args):
+        """await action(*args) once it's our turn"""
+        if self.inside():
+            # already our turn, waiting would deadlock
+            return await action(*args)
+        return await self.post(lambda: action(*args))
+
+    async def work(self):
+        while not (self.closed and self.held is None and
+                   self.mailbox.empty()):
+            if self.held is not None:
+                item, self.held = self.held, None
+            else:
+                item = await self.mailbox.get()
+            if item[2]:
+                await self.run_batch(self.take_batch(item))
+            else:
+                await self.run_one(item)
+
+    def take_batch(self, item):
+        batch = [item]
+        while not self.mailbox.empty():
+            item = self.mailbox.get_nowait()
+            if not item[2]:
+                self.held = item
+                break
+            batch.append(item)
+        return batch
+
+    async def run_one(self, item):
+        apply, publish, batch, future = item
+        self.actions += 1
+        try:
+            if self.before is not None:
+                self.before()
+            result = await apply()
+            if publish is not None:
+                await publish(result)
+        except Exception as err:
+            if not future.done():
+                future.set_exception(err)
+        else:
+            if not future.done():
+                future.set_result(result)
+
+    async def run_batch(self, batch):
+        self.actions += len(batch)
+        self.batches += 1
+        self.max_batch = max(self.max_batch, len(batch))
+        logger.debug('Applying %d queued actions in one go.', len(batch))
+        # one pass over the game first, nothing can get in between
+        results = []
+        if self.before is not None:
+            try:
+                self.before()
+            except Exception as err:
+                for apply, publish, _batch, future in batch:
+                    if not future.done():
+                        future.set_exception(err)
+                return
+        for apply, publish, _batch, future in batch:
+            try:
+                results.append((apply(), None))
+            except Exception as err:
+                results.append((None, err))
+        # then tell everybody
+        for (apply, publish, _batch, future), (result, err) in zip(
+                batch, results):
+            if err is None and publish is not None:
+                try:
+                    await publish(result)
+                except Exception as publish_err:
+                    err = publish_err
+            if future.done():
+                continue
+            if err is not None:
+                future.set_exception(err)
+            else:
+                future.set_result(result)
+
+    def close(self):
+        """finish what's queued, then stop the worker"""
+        self.closed = True
+        if (self.worker is not None and not self.worker.done() and
+                not self.inside()):
+            # wake it up in case it's waiting for mail
+            self.post(GameActor.noop)
+
+    @staticmethod
+    async def noop():
+        pass
+
+    def stats(self):
+        return {
+            'queued': self.mailbox.qsize(),
+            'actions': self.actions,
+            'batches': self.batches,
+            'max_batch': self.max_batch,
+        }
+
+
+class Shard():
+    """the games of the guilds on one gateway connection, and its load"""
+
+    def __init__(self, shard_id):
+        self.id = shard_id
+        self.games = {}
+        self.events = 0
+        self.since = time.monotonic()
+
+    def stats(self, reset=False):
+        """games and events per second since the last reset"""
+        now = time.monotonic()
+        elapsed = now - self.since
+        stats = {
+            'shard': self.id,
+            'games': len(self.games),
+            'running': sum(m.game.status != mafia.GameStatus.NOT_RUNNING
+                           for m in self.games.values()),
+            'events': self.events,
+            'events_per_sec': self.events / elapsed if elapsed else 0,
+        }
+        if reset:
+            self.events = 0
+            self.since = now
+        return stats
+
+
+# config settings that name a channel and a role, see GuildLayout
+CHANNEL_SETTINGS = ('category', 'open_channel', 'open_voice_channel',
+                    'mafia_channel', 'mafia_voice_channel', 'cop_channel',
+                    'cop_voice_channel')
+ROLE_SETTINGS = ('alive_role', 'dead_role')
+
+
+class GuildLayout():
+    """where a guild's game channels and roles are
+
+    The IDs in the config are those of the guild the bot got set up in.
+    Every other guild gets its game in the channels and roles named like
+    those (see learn()), so one bot can serve any number of guilds.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        # setting -> (name, channel type or None for roles)
+        self.names = {}
+        # guild id -> {setting: channel or role, None if there's none}
+        self.guilds = {}
+
+    def learn(self, guilds):
+        """remember the names of the configured channels and roles"""
+        for guild in guilds:
+            for setting in CHANNEL_SETTINGS:
+                channel = guild.get_channel(getattr(self.config, setting))
+                if channel is not None:
+                    self.names[setting] = (channel.name, str(channel.type))
+            for setting in ROLE_SETTINGS:
+                role = guild.get_role(getattr(self.config, setting))
+                if role is not None:
+                    self.names[setting] = (role.name, None)
+        self.guilds.clear()
+
+    def named(self, candidates, setting, category=None):
+        """the candidate named like setting, in category if there's one"""
+        if setting not in self.names:
+            return None
+        name, kind = self.names[setting]
+        matches = [c for c in candidates if c.name == name and
+                   (kind is None or str(c.type) == kind)]
+        for match in matches:
+            if category is None or match.category == category:
+                return match
+        return matches[0] if matches else None
+
+    def resolve(self, guild):
+        """{setting: channel or role (or None)} of guild"""
+        found = self.guilds.get(guild.id)
+        if found is None:
+            found = {}
+            for setting in CHANNEL_SETTINGS:
+                found[setting] = (
+                    guild.get_channel(getattr(self.config, setting)) or
+                    self.named(guild.channels, setting, found.get('category')))
+            for setting in ROLE_SETTINGS:
+                found[setting] = (
+                    guild.get_role(getattr(self.config, setting)) or
+                    self.named(guild.roles, setting))
+            self.guilds[guild.id] = found
+        return found
+
+    def concerns(self, channel):
+        """whether channel is (or could become) one of our game channels"""
+        return (channel.id in self.config.game_channels or
+                any(channel.name == self.names[setting][0]
+                    for setting in CHANNEL_SETTINGS
+                    if setting in self.names))
+
+    def forget(self, guild):
+        self.guilds.pop(guild.id, None)
+
+
+class GameRegistry():
+    """keeps one Game/MafiaBot pair per guild (and optionally per lobby)
+
+    The games are kept per shard, so handling an event only ever
+    touches the games of the shard it came in on.
+    """
+
+    def __init__(self, config, game_factory=mafia.Game, shard_count=1,
+                 store=None):
+        self.config = config
+        self.game_factory = game_factory
+        self.shard_count = shard_count
+        # if there's a state store, games live there instead of journals
+        # and other workers can take them over
+        self.store = store
+        if store is None and config.state_store:
+            self.store = open_store(config.state_store)
+        self.owner = (config.worker_id or
+                      f'{socket.gethostname()}-{os.getpid()}')
+        self.renewer = None
+        # guild key -> when the worker that has its game might let go
+        self.elsewhere = {}
+        # finished games of all guilds
+        self.archive = None
+        if config.history_dir:
+            self.archive = HistoryArchive(config.history_dir)
+        # shard id -> Shard
+        self.shards = {}
+        # if set, every game gets journaled there so it survives restarts
+        self.journal_dir = config.journal_dir
+        if self.journal_dir:
+            os.makedirs(self.journal_dir, exist_ok=True)
+        # guild id -> BedPool, these outlive the games
+        self.bed_pools = {}
+        # the phase timers of all games
+        self.timers = TimerWheel()
+        # guild id -> IDs of the channels we listen to there
+        self.accepted = {}
+        # the game channels and roles of every guild
+        self.layout = GuildLayout(config)
+
+    def key(self, guild, lobby=None):
+        if isinstance(guild, int):
+            return (guild, lobby)
+        if lobby is None:
+            lobby = self.lobby(guild)
+        return (guild.id, lobby)
+
+    def lobby(self, guild, channel=None):
+        """the lobby (game category) of a guild, or of one of its channels
+
+        There's one lobby per guild for now, any of its game channels
+        leads there. None if the guild has no game category.
+        """
+        if (channel is not None and
+                channel.id not in self.accepted_channels(guild)):
+            return None
+        category = self.layout.resolve(guild)['category']
+        return None if category is None else category.id
+
+    def shard(self, guild):
+        """the Shard a guild (or guild id) belongs to"""
+        shard_id = getattr(guild, 'shard_id', None)
+        if shard_id is None:
+            # how discord assigns guilds to shards
+            guild_id = guild if isinstance(guild, int) else guild.id
+            shard_id = (guild_id >> 22) % self.shard_count
+        shard = self.shards.get(shard_id)
+        if shard is None:
+            shard = self.shards[shard_id] = Shard(shard_id)
+        return shard
+
+    def reshard(self, shard_count):
+        """move the games around after the number of shards changed"""
+        if shard_count == self.shard_count:
+            return
+        self.shard_count = shard_count
+        games = [(key, m) for shard in self.shards.values()
+                 for key, m in shard.games.items()]
+        for shard in self.shards.values():
+            shard.games.clear()
+        for key, mafiabot in games:
+            self.shard(key[0]).games[key] = mafiabot
+        logger.info('Now running on %d shards.', shard_count)
+
+    def get(self, guild, lobby=None):
+        """look up the game for a guild/lobby, create it if there is none"""
+        key = self.key(guild, lobby)
+        games = self.shard(guild).games
+        mafiabot = games.get(key)
+        if mafiabot is None:
+            mafiabot = MafiaBot(self.new_game(key), self.config,
+                                self.bed_pool(key[0]), self.timers,
+                                self.archive, self.layout)
+            games[key] = mafiabot
+            logger.debug('Created game for %s.', key)
+        return mafiabot
+
+    def new_game(self, key):
+        if self.store is not None:
+            # raises NotOwnerError if another worker has the game
+            game = StoreJournal(self.store, self.journal_name(key),
+                                self.owner).attach(self.game_factory())
+            if self.renewer is None:
+                self.renewer = self.timers.schedule(LEASE_SEC / 3,
+                                                    self.renew_leases)
+            return game
+        if not self.journal_dir:
+            return self.game_factory()
+        journal = Journal(os.path.join(self.journal_dir,
+                                       self.journal_name(key)))
+        if journal.exists():
+            return journal.recover(self.game_factory())
+        return journal.attach(self.game_factory())
+
+    def journal_name(self, key):
+        guild_id, lobby = key
+        return str(guild_id) if lobby is None else f'{guild_id}-{lobby}'
+
+    def recover(self, shard_ids=None):
+        """bring back every game that has a journal, e.g. after a restart
+
+        With a state store, that's the games of our shards (all if
+        shard_ids is None) that no other worker holds on to.
+        """
+        if self.store is not None:
+            names = set(self.store.keys())
+        elif self.journal_dir:
+            names = {os.path.splitext(f)[0]
+                     for f in os.listdir(self.journal_dir)
+                     if f.endswith('.log') or f.endswith('.snap')}
+        else:
+            return []
+        recovered = []
+        for name in names:
+            guild_id, _sep, lobby = name.partition('-')
+            if lobby.isdigit():
+                lobby = int(lobby)
+            guild_id = int(guild_id)
+            if (shard_ids is not None and
+                    self.shard(guild_id).id not in shard_ids):
+                continue
+            try:
+                recovered.append(self.get(guild_id, lobby or None))
+            except NotOwnerError as err:
+                logger.info('Game %s belongs to %s.', name, err.owner)
+        logger.info('Recovered %d games.', len(recovered))
+        return recovered
+
+    def owns(self, guild):
+        """whether this worker serves guild's game (claiming it if free)"""
+        if self.store is None or self.find(guild) is not None:
+            return True
+        key = self.key(guild)
+        if self.elsewhere.get(key, 0) > time.time():
+            return False
+        try:
+            self.get(guild)
+        except NotOwnerError as err:
+            self.elsewhere[key] = err.until or 0
+            return False
+        self.elsewhere.pop(key, None)
+        return True
+
+    async def renew_leases(self):
+        """keep our games, forget the ones another worker took over"""
+        games = {self.journal_name(key): (shard, key)
+                 for shard in self.shards.values() for key in shard.games}
+        try:
+            # renewing all of them at once can wait on the database
+            kept = set(await asyncio.get_event_loop().run_in_executor(
+                None, self.store.renew, list(games), self.owner))
+            for name, (shard, key) in games.items():
+                if name not in kept and shard.games.get(key) is not None:
+                    logger.warning('Lost game %s to another worker.', name)
+                    mafiabot = shard.games.pop(key)
+                    mafiabot.timer_stop()
+                    mafiabot.actor.close()
+        except Exception:
+            # the leases last a few renewals, try again next time
+            logger.exception('Could not renew the leases.')
+        finally:
+            self.renewer = self.timers.schedule(LEASE_SEC / 3,
+                                                self.renew_leases)
+
+    def release(self):
+        """hand all games over to other workers, e.g. on shutdown"""
+        if self.renewer is not None:
+            self.renewer.cancel()
+            self.renewer = None
+        for mafiabot in self:
+            if mafiabot.game.journal is not None:
+                mafiabot.game.journal.close()
+
+    def sync(self):
+        """make sure all journals are on disk"""
+        for mafiabot in self:
+            if mafiabot.game.journal is not None:
+                mafiabot.game.journal.sync()
+
+    def bed_pool(self, guild_id):
+        if guild_id not in self.bed_pools:
+            self.bed_pools[guild_id] = BedPool(self.config.bed_pool_size)
+        return self.bed_pools[guild_id]
+
+    async def close(self):
+        """delete the pooled beds of all guilds"""
+        await asyncio.gather(*(pool.clear()
+                               for pool in self.bed_pools.values()))
+
+    def find(self, guild, lobby=None):
+        """look up the game for a guild/lobby without creating one"""
+        return self.shard(guild).games.get(self.key(guild, lobby))
+
+    def accepted_channels(self, guild):
+        """IDs of the game channels in guild, checked on every message"""
+        accepted = self.accepted.get(guild.id)
+        if accepted is None:
+            channels = self.layout.resolve(guild)
+            accepted = frozenset(channels[setting].id
+                                 for setting in CHANNEL_SETTINGS
+                                 if channels[setting] is not None)
+            self.accepted[guild.id] = accepted
+        return accepted
+
+    def channels_changed(self, guild):
+        """forget what we know about guild's channels"""
+        self.accepted.pop(guild.id, None)
+        self.layout.forget(guild)
+        for (guild_id, lobby), mafiabot in self.shard(guild).games.items():
+            if guild_id == guild.id:
+                mafiabot.channels = {}
+
+    def evict(self, guild, lobby=None):
+        """forget a game, e.g. after it was stopped"""
+        mafiabot = self.shard(guild).games.pop(self.key(guild, lobby), None)
+        if mafiabot is not None:
+            mafiabot.timer_stop()
+            mafiabot.actor.close()
+            if mafiabot.game.journal is not None:
+                # the game is over, nothing to recover
+                mafiabot.game.journal.close(remove=True)
+            logger.debug('Evicted game for %s.', self.key(guild, lobby))
+        return mafiabot
+
+    def running(self):
+        return [m for m in self
+                if m.game.status != mafia.GameStatus.NOT_RUNNING]
+
+    def stats(self, reset=False):
+        """Shard.stats of every shard"""
+        return [self.shards[shard_id].stats(reset)
+                for shard_id in sorted(self.shards)]
+
+    def __len__(self):
+        return sum(len(shard.games) for shard in self.shards.values())
+
+    def __iter__(self):
+        for shard in list(self.shards.values()):
+            yield from list(shard.games.values())
+
+
+class ChannelAudience(mafia.GameObserver):
+    """IDs of the players that may see/write in the game channels.
+
+    The sets get updated as players join, get their roles or die (the
+    game tells us, see Game.observers), so a phase change only has to
+    pick the right ones instead of going through all players.
+    """
+    NOBODY = frozenset()
 
     def __init__(self, game):
+        self.sets = {name: set() for name in (
+            'everyone', 'alive', 'not_alive', 'mafia_view', 'mafia_write',
+            'cop_view', 'cop_write')}
+        # player ID -> names of the sets they're in
+        self.member_of = {}
+        self.rebuild(game)
+        game.observers.append(self)
+
+    @staticmethod
+    def sets_for(player):
+        alive = player.status == mafia.PlayerStatus.ALIVE
+        names = ['everyone', 'alive' if alive else 'not_alive']
+        for role, view, write in (
+                (mafia.Role.MAFIA, 'mafia_view', 'mafia_write'),
+                (mafia.Role.COP, 'cop_view', 'cop_write')):
+            # dead players and players without a role yet see everything
+            if (player.role in (role, mafia.Role.UNASSIGNED) or
+                    not alive):
+                names.append(view)
+            if player.role == role and alive:
+                names.append(write)
+        return frozenset(names)
+
+    def players_changed(self, game, players):
+        if players is None:
+            self.rebuild(game)
+            return
+        for p in players:
+            self.update(p)
+
+    def update(self, player):
+        old = self.member_of.get(player.ID, self.NOBODY)
+        new = self.sets_for(player)
+        for name in old - new:
+            self.sets[name].discard(player.ID)
+        for name in new - old:
+            self.sets[name].add(player.ID)
+        self.member_of[player.ID] = new
+
+    def rebuild(self, game):
+        for ids in self.sets.values():
+            ids.clear()
+        self.member_of.clear()
+        for p in game.players:
+            self.update(p)
+
+    def permits(self, view, write):
+        """the sets (not copies) as get_*_channel_users returns them"""
+        return {Permissions.ALLOW_VIEW: self.sets[view],
+                Permissions.ALLOW_WRITE: (self.sets[write] if write
+                                          else self.NOBODY)}
+
+
+class PhaseContext():
+    """the ctx of a phase no command started, replies go to channel"""
+
+    def __init__(self, guild, channel):
+        self.guild = guild
+        self.channel = channel
+
+    async def send(self, content):
+        return await self.channel.send(content)
+
+
+class MafiaBot():
+
+    def __init__(self, game, config, bed_pool=None, timers=None,
+                 archive=None, layout=None):
+        self.config = config
+        self.layout = layout if layout is not None else GuildLayout(config)
+        # all games share the registry's wheel
+        self.timers = timers if timers is not None else TimerWheel()
         self.timer = None
+        # counts timer restarts, timeouts of older phases get ignored
+        self.timer_phase = 0
+        # everything that changes the game goes through here
+        self.actor = GameActor(self.refresh)
         self.game = game
+        # who may see and write where, kept up to date by the game
+        self.audience = ChannelAudience(game)
+        if archive is not None:
+            GameRecorder(game, archive)
         self.ctx = None
         self.before_warning_time = True
         self.channels = {}
         self.userchannels = {}
-        self.fakeuserbots = []
+        # member id -> task getting their bed ready
+        self.bed_tasks = {}
+        self.bed_pool = (bed_pool if bed_pool is not None
+                         else BedPool(config.bed_pool_size))
+        # channel id -> overwrites we last sent for that channel
+        self.applied_overwrites = {}
+        # seconds the last batch of voice moves took
+        self.last_move_latency = 0
+        # what we rendered at game.version render_version, see rendered()
+        self.render_cache = {}
+        self.render_version = None
+
+    def refresh(self):
+        """pick up changes other workers made to a shared game"""
+        if hasattr(self.game.journal, 'refresh'):
+            self.game.journal.refresh(self.game)
 
     def get_channels(self, guild=None):
         if not self.channels:
-            self.channels = {
-                'open_channel': guild.get_channel(OPEN_CHANNEL),
-                'open_voice_channel': guild.get_channel(OPEN_VOICE_CHANNEL),
-                'mafia_channel': guild.get_channel(MAFIA_CHANNEL),
-                'mafia_voice_channel': guild.get_channel(MAFIA_VOICE_CHANNEL),
-                'cop_channel': guild.get_channel(COP_CHANNEL),
-                'cop_voice_channel': guild.get_channel(COP_VOICE_CHANNEL),
-                'category': guild.get_channel(DISCORD_CATEGORY)
-            }
+            resolved = self.layout.resolve(guild)
+            self.channels = {setting: resolved[setting]
+                             for setting in CHANNEL_SETTINGS}
         return self.channels
 
+    def overwrites_diff(self, channel, overwrites):
+        """what changed since we last set the overwrites of a channel
+
+        Returns None if we don't know the current state (first time, or
+        after a reset), otherwise a dict of the targets whose overwrite
+        changed, with None for overwrites that have to be removed.
+        """
+        applied = self.applied_overwrites.get(channel.id)
+        if applied is None:
+            return None
+        diff = {}
+        for target, overwrite in overwrites.items():
+            if applied.get(target) != overwrite:
+                diff[target] = overwrite
+        for target in applied:
+            if target not in overwrites:
+                diff[target] = None
+        return diff
+
+    def overwrites_applied(self, channel, overwrites=None):
+        """remember the overwrites of a channel, forget them if None"""
+        if overwrites is None:
+            self.applied_overwrites.pop(channel.id, None)
+        else:
+            self.applied_overwrites[channel.id] = dict(overwrites)
+
     def get_assigned_channels(self):
         channels = {}
         phase = self.game.status
@@ -110,112 +852,109 @@ class MafiaBot():
 
     def get_open_channel_users(self):
         """users and permissions for an open channel"""
-        allow_view, allow_write = [], []
-        for p in self.game.players:
-            # everybody can see
-            allow_view.append(p)
-            if (p.status == mafia.PlayerStatus.ALIVE):
-                # but only living players can write
-                allow_write.append(p)
-        return {Permissions.ALLOW_VIEW: allow_view,
-                Permissions.ALLOW_WRITE: allow_write}
+        # everybody can see, but only living players can write
+        return self.audience.permits('everyone', 'alive')
 
     def get_openblocked_channel_users(self):
         """users and permissions for open channel but currently blocked"""
-        allow_view, allow_write = [], []
-        for p in self.game.players:
-            # everybody can see
-            allow_view.append(p)
-            # but noone can write, so allow_write stays empty
-        return {Permissions.ALLOW_VIEW: allow_view,
-                Permissions.ALLOW_WRITE: allow_write}
+        # everybody can see, but noone can write
+        return self.audience.permits('everyone', None)
 
     def get_hidden_channel_users(self):
         """users and permissions for a completely hidden channel"""
-        allow_view, allow_write = [], []
-        for p in self.game.players:
-            if (p.status != mafia.PlayerStatus.ALIVE):
-                # only nonactive players (dead or visiting) can see
-                allow_view.append(p)
-                # and noone can write, so allow_write stays empty
-        return {Permissions.ALLOW_VIEW: allow_view,
-                Permissions.ALLOW_WRITE: allow_write}
+        # only nonactive players (dead or visiting) can see, noone writes
+        return self.audience.permits('not_alive', None)
 
     def get_mafia_channel_users(self):
         """users and permissions for mafia channel when active"""
-        allow_view, allow_write = [], []
-        for p in self.game.players:
-            if (p.role == mafia.Role.MAFIA or
-                p.role == mafia.Role.UNASSIGNED or
-                    p.status != mafia.PlayerStatus.ALIVE):
-                allow_view.append(p)
-                if (p.role == mafia.Role.MAFIA and
-                        p.status == mafia.PlayerStatus.ALIVE):
-                    allow_write.append(p)
-        return {Permissions.ALLOW_VIEW: allow_view,
-                Permissions.ALLOW_WRITE: allow_write}
+        return self.audience.permits('mafia_view', 'mafia_write')
 
     def get_cop_channel_users(self):
         """users and permissions for cop channel when active"""
-        allow_view, allow_write = [], []
-        for p in self.game.players:
-            if (p.role == mafia.Role.COP or
-                p.role == mafia.Role.UNASSIGNED or
-                    p.status != mafia.PlayerStatus.ALIVE):
-                allow_view.append(p)
-                if (p.role == mafia.Role.COP and
-                        p.status == mafia.PlayerStatus.ALIVE):
-                    allow_write.append(p)
-        return {Permissions.ALLOW_VIEW: allow_view,
-                Permissions.ALLOW_WRITE: allow_write}
+        return self.audience.permits('cop_view', 'cop_write')
 
     def get_cophidden_channel_users(self):
         """users and permissions for cop channel when not active"""
-        allow_view, allow_write = [], []
-        for p in self.game.players:
-            if (p.role == mafia.Role.COP or
-                p.role == mafia.Role.UNASSIGNED or
-                    p.status != mafia.PlayerStatus.ALIVE):
-                allow_view.append(p)
-        return {Permissions.ALLOW_VIEW: allow_view,
-                Permissions.ALLOW_WRITE: allow_write}
+        return self.audience.permits('cop_view', None)
 
     async def timer_start(self, ctx, callmethod):
-        if self.timer:
-            self.timer.cancel()
+        self.timer_stop()
         self.before_warning_time = True
         if self.game.status in [mafia.GameStatus.DAY_TALK,
                                 mafia.GameStatus.DAY_VOTE]:
-            time = WAITING_TIME_DAY_IN_SEC - WARNING_TIMER_IN_SEC
+            time = (self.config.wait_day_sec -
+                    self.config.warning_timer_sec)
         else:
-            time = WAITING_TIME_NIGHT_IN_SEC - WARNING_TIMER_IN_SEC
+            time = (self.config.wait_night_sec -
+                    self.config.warning_timer_sec)
         self.timer_callmethod = callmethod
         self.ctx = ctx
-        self.timer = asyncio.create_task(self.timer_cycle(time))
+        self.timer = self.timers.schedule(time, self.timer_cycle,
+                                          self.timer_phase)
+
+    async def resume(self, guild, callmethod):
+        """restart the phase timer of a game recovered mid-phase
+
+        E.g. after a restart, or taken over from a worker that died.
+        """
+        if self.ctx is not None or (self.game.status ==
+                                    mafia.GameStatus.NOT_RUNNING):
+            return
+        open_channel = self.get_channels(guild)['open_channel']
+        logger.info('Resuming the phase timer in %s.', guild)
+        await self.timer_start(PhaseContext(guild, open_channel),
+                               callmethod)
 
-    async def timer_cycle(self, time):
-        await asyncio.sleep(time)
+    def timer_stop(self):
+        if self.timer:
+            self.timer.cancel()
+        self.timer_phase += 1
+
+    async def timer_cycle(self, phase):
+        # timers fire outside the actor, so get in line like a command
+        await self.actor.run(self.timer_step, phase)
+
+    async def timer_step(self, phase):
+        if phase != self.timer_phase:
+            # a vote or command got here first and moved the game on
+            return
+        channels = self.get_channels(self.ctx.guild)
         if self.before_warning_time:
-            msg = _('Only') + " " + str(WARNING_TIMER_IN_SEC) + " "
+            self.before_warning_time = False
+            self.timer = self.timers.schedule(self.config.warning_timer_sec,
+                                              self.timer_cycle, phase)
+            msg = _('Only') + " " + str(self.config.warning_timer_sec) + " "
             msg += _('seconds left!')
             if self.game.status in [mafia.GameStatus.DAY_TALK,
                                     mafia.GameStatus.DAY_VOTE]:
-                await self.get_channels()['open_channel'].send(msg)
+                await channels['open_channel'].send(msg)
             else:
-                await self.get_channels()['mafia_channel'].send(msg)
-                await self.get_channels()['cop_channel'].send(msg)
-            self.before_warning_time = False
-            self.timer = asyncio.create_task(
-                self.timer_cycle(WARNING_TIMER_IN_SEC))
+                await channels['mafia_channel'].send(msg)
+                await channels['cop_channel'].send(msg)
         else:
-            await self.get_channels()['open_channel'].send(
-                _('Time ran out!'))
-            await self.timer_callmethod(self.ctx, False, True)  # cycle()
-            await self.timer_start(self.ctx, self.timer_callmethod)
+            await channels['open_channel'].send(_('Time ran out!'))
+            # cycle(), of this game even if there's a new one by now
+            await self.timer_callmethod(self.ctx, False, True,
+                                        myMafiaBot=self)
+            # unless that was the end of the game
+            if self.game.status != mafia.GameStatus.NOT_RUNNING:
+                await self.timer_start(self.ctx, self.timer_callmethod)
+
+    def rendered(self, key, render, *args):
+        """render(*args), but only once per game version"""
+        if self.render_version != self.game.version:
+            self.render_cache.clear()
+            self.render_version = self.game.version
+        msg = self.render_cache.get(key)
+        if msg is None:
+            msg = self.render_cache[key] = render(*args)
+        return msg
 
     def print_players(self, roles=False):
+        return self.rendered(('players', roles), self.render_players, roles)
+
+    def render_players(self, roles):
         try:
-            msg = "Players:\n"
             living, dead, unknown = [], [], []
             for p in self.game.players:
                 if p.status == mafia.PlayerStatus.ALIVE:
@@ -224,17 +963,15 @@ class MafiaBot():
                     dead.append(p)
                 else:
                     unknown.append(p)
-            switcher = {
-                mafia.PlayerStatus.ALIVE: _('alive'),
-                mafia.PlayerStatus.DEAD: _('dead'),
-                mafia.PlayerStatus.JOINED: _('waiting')
-            }
+            lines = ["Players:"]
             for p in living + dead + unknown:  # sort: living first, then dead
-                msg += "    - " + str(p.name) + " ("
-                msg += switcher.get(p.status, _('unknown status')) + ")"
+                line = ("    - " + str(p.name) + " (" +
+                        self.read_player_status(p.status) + ")")
                 if roles:
-                    msg += " [" + self.read_role(p.role) + "]"
-                msg += "\n"
+                    line += " [" + self.read_role(p.role) + "]"
+                lines.append(line)
+            lines.append("")
+            msg = "\n".join(lines)
         except mafia.Error as err:
             err.context = ErrorContext.PRINT_PLAYERS_ATTEMPT
             msg = self.error_message(err)
@@ -242,6 +979,9 @@ class MafiaBot():
             return msg
 
     def print_game_status(self):
+        return self.rendered(('game_status',), self.render_game_status)
+
+    def render_game_status(self):
         try:
             msg = self.read_game_status(self.game.status)
         except mafia.Error as err:
@@ -250,6 +990,21 @@ class MafiaBot():
         finally:
             return msg
 
+    def print_status(self, game_status=True, player_status=False,
+                     player_roles=False):
+        """what send_status_update sends"""
+        return self.rendered(('status', game_status, player_status,
+                              player_roles), self.render_status,
+                             game_status, player_status, player_roles)
+
+    def render_status(self, game_status, player_status, player_roles):
+        parts = []
+        if game_status:
+            parts.append(self.print_game_status() + "\n")
+        if player_status:
+            parts.append(self.print_players(player_roles) + "\n")
+        return "".join(parts)
+
     def error_message(self, err):
         switcher = {
             mafia.AlreadyVotedError: self.already_voted_err,
@@ -260,6 +1015,11 @@ class MafiaBot():
             mafia.AlreadyJoinedError: self.already_joined_err,
             mafia.NotRunningError: self.not_running_err,
             mafia.WinnerAlreadyDeadError: self.winner_dead_err,
+            mafia.WrongVoteError: self.wrong_vote_err,
+            mafia.PlayerNotFoundError: self.player_not_found_err,
+            mafia.AmbiguousPlayerError: self.ambiguous_player_err,
+            NotOwnerError: self.not_owner_err,
+            StaleStateError: self.stale_state_err,
             mafia.Error: self.default_error
         }
         msg = switcher.get(err.__class__)(err)
@@ -318,6 +1078,35 @@ class MafiaBot():
     def already_joined_err(self, err):
         return err.player.name + " " + _('already joined.')
 
+    def wrong_vote_err(self, err):
+        return _('You can only vote for players.')
+
+    def player_not_found_err(self, err):
+        return _('Nobody alive goes by') + " " + err.name + "."
+
+    def ambiguous_player_err(self, err):
+        return (err.name + " " + _('could be') + " " +
+                ", ".join(p.name for p in err.players) + ".")
+
+    def not_owner_err(self, err):
+        if err.owner is None:
+            # nobody has it, the store was just busy
+            return self.stale_state_err(err)
+        return _('Another bot instance is running this game.')
+
+    def stale_state_err(self, err):
+        return _('The game changed in the meantime, please try again.')
+
+    def find_target(self, target):
+        """the ID of who target means: a ping, an ID or (part of) a name"""
+        target = target.strip()
+        match = MENTION.match(target)
+        if match:
+            return int(match.group(1))
+        if target.isdigit() and self.game.has_player(int(target)):
+            return int(target)
+        return self.game.find_player(target).ID
+
     def read_game_status(self, status):
         switcher = {
             mafia.GameStatus.NOT_RUNNING: _('The game is not running.'),
@@ -328,6 +1117,14 @@ class MafiaBot():
         }
         return switcher.get(status)
 
+    def read_player_status(self, status):
+        switcher = {
+            mafia.PlayerStatus.ALIVE: _('alive'),
+            mafia.PlayerStatus.DEAD: _('dead'),
+            mafia.PlayerStatus.JOINED: _('waiting')
+        }
+        return switcher.get(status, _('unknown status'))
+
     def read_role(self, role):
         switcher = {
             mafia.Role.VILLAGER: _('villager'),
@@ -338,44 +1135,74 @@ class MafiaBot():
         return switcher.get(role)
 
     async def move_to_their_own_channel(self, guild, member):
+        await member.move_to(await self.get_their_own_channel(guild, member))
+
+    async def get_their_own_channel(self, guild, member):
         if member.id in self.userchannels:
-            await member.move_to(self.userchannels[member.id])
-        else:
-            overwrites = {
-                guild.default_role: discord.PermissionOverwrite(
-                    read_messages=False),
-                member: discord.PermissionOverwrite(
-                    read_messages=True, speak=False)
-            }
-            category = self.get_channels(guild)['category']
-            secret_channel = await guild.create_voice_channel(
-                _('Your bed'),
-                category=category,
-                overwrites=overwrites)
-            self.userchannels[member.id] = secret_channel
-            await member.move_to(self.userchannels[member.id])
+            return self.userchannels[member.id]
+        return await self.prepare_bed(guild, member)
+
+    def prepare_bed(self, guild, member):
+        """get a bed ready in the background"""
+        if member.id not in self.bed_tasks:
+            task = asyncio.ensure_future(self.make_bed(guild, member))
+            task.add_done_callback(bed_done)
+            self.bed_tasks[member.id] = task
+        return self.bed_tasks[member.id]
+
+    def warm_bed(self, guild, member):
+        """prepare_bed ahead of time, e.g. as soon as they join
+
+        Only for members in voice (nobody else gets moved to bed), and
+        no more than the pool keeps, a category only takes 50 channels.
+        """
+        if member.voice is None or member.id in self.userchannels:
+            return None
+        if (member.id not in self.bed_tasks and
+                len(self.bed_tasks) + len(self.userchannels) >=
+                self.bed_pool.size):
+            return None
+        return self.prepare_bed(guild, member)
+
+    async def make_bed(self, guild, member):
+        category = self.get_channels(guild)['category']
+        acquiring = asyncio.ensure_future(
+            self.bed_pool.acquire(guild, category, member))
+        try:
+            # cancelling us doesn't stop the channel from being made, so
+            # let that finish and leave the bed to whoever cancelled us
+            bed = await asyncio.shield(acquiring)
+        except asyncio.CancelledError:
+            return await acquiring
+        finally:
+            if self.bed_tasks.get(member.id) is asyncio.current_task():
+                del self.bed_tasks[member.id]
+        self.userchannels[member.id] = bed
+        return bed
 
     async def remove_userchannels(self, guild):
-        for ch in self.userchannels.values():
-            await ch.delete()
+        tasks = list(self.bed_tasks.values())
+        self.bed_tasks.clear()
+        for task in tasks:
+            task.cancel()
+        made = await asyncio.gather(*tasks, return_exceptions=True)
+        beds = list(self.userchannels.values())
         self.userchannels.clear()
+        beds += [bed for bed in made
+                 if bed is not None and not isinstance(bed, BaseException)
+                 and bed not in beds]
+        await self.bed_pool.release(guild, beds)
 
-    # BULLSHIT
-    # EINFAHC LASSEN
-    async def createfakeuserbots(self):
-        if self.fakeuserbots is not None:
+    async def sweep_beds(self, guild):
+        """take back the beds a previous run left behind, e.g. a crash"""
+        category = self.get_channels(guild)['category']
+        if category is None:
             return
-        user1 = os.getenv('MAFIA_USER1')
-        user2 = os.getenv('MAFIA_USER2')
-        user3 = os.getenv('MAFIA_USER3')
-        user4 = os.getenv('MAFIA_USER4')
-        user5 = os.getenv('MAFIA_USER5')
-        fakes = [user1, user2, user3, user4, user5]
-        loop = asyncio.get_event_loop()
-        for f in fakes:
-            if f is None:
-                return False
-            else:
-                self.fakeuserbots.append(discord.Client())
-                i = self.fakeuserbots[-1]
-                loop.create_task(i.start(f))
+        used = set(self.userchannels.values()) | set(self.bed_pool.free)
+        left = [ch for ch in guild.channels
+                if ch.category == category and str(ch.type) == 'voice' and
+                ch.name == _('Your bed') and not ch.members and
+                ch not in used]
+        if left:
+            logger.info('Found %d beds left behind.', len(left))
+            await self.bed_pool.release(guild, left)